@@ -1,17 +1,33 @@
+from gevent import monkey  # isort:skip # noqa
+
+monkey.patch_all()  # isort:skip # noqa
+
+import hashlib
 import json
+import sqlite3
 import sys
 import time
+from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from json import JSONDecodeError
 from pathlib import Path
-from typing import Any, Dict, List, Optional, TextIO, cast
-from urllib.parse import urlparse
+from typing import Any, Collection, Dict, Iterable, List, Optional, Set, TextIO, Tuple
+from urllib.parse import quote, urlparse
 
 import click
 import docker
+import gevent
 import requests
-import yaml
+from gevent.pool import Pool
 from matrix_client.errors import MatrixError
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    start_http_server,
+    write_to_textfile,
+)
 from typing_extensions import TypedDict
 
 from raiden.constants import DISCOVERY_DEFAULT_ROOM, Environment, Networks
@@ -20,9 +36,134 @@ from raiden.network.transport.matrix.client import GMatrixHttpApi
 from raiden.settings import DEFAULT_MATRIX_KNOWN_SERVERS
 from raiden.utils.typing import ChainID
 
-SYNAPSE_CONFIG_PATH = "/config/synapse.yaml"
+try:
+    import psycopg2
+    from psycopg2 import Error as DatabaseError
+except ImportError:  # pragma: no cover
+    psycopg2 = None
+
+    class DatabaseError(Exception):  # type: ignore
+        pass
+
+
+# Written by the synapse entrypoint, contains the hash of the whitelist the container loaded
+SYNAPSE_WHITELIST_HASH_PATH = "/run/synapse_whitelist.sha256"
 USER_PURGING_THRESHOLD = 2 * 24 * 60 * 60  # 2 days
 USER_ACTIVITY_PATH = Path("/config/user_activity.json")
+USER_ACTIVITY_DB_PATH = Path("/config/user_activity.db")
+WHITELIST_CACHE_FILENAME = "federation_whitelist_cache.json"
+WHITELIST_FETCH_TIMEOUT = 30
+# Label value of containers which are restarted after the others, see restart_outdated_containers
+RESTART_LABEL_WORKER = "worker"
+CONTAINER_HEALTH_TIMEOUT = 300
+CONTAINER_HEALTH_POLL_INTERVAL = 5
+DEFAULT_COMMIT_BATCH_SIZE = 500
+MEMBER_SYNC_FULL = "full"
+MEMBER_SYNC_INCREMENTAL = "incremental"
+MEMBER_EVENTS_FILTER = json.dumps({"types": ["m.room.member"]})
+MEMBER_EVENTS_PAGE_SIZE = 1000
+DEFAULT_PURGE_CONCURRENCY = 2
+DEFAULT_MAX_PURGES_PER_RUN = 1000
+PURGE_MAX_ATTEMPTS = 5
+PURGE_RETRY_BACKOFF = 6 * 60 * 60  # doubled with every failed attempt
+PURGE_JOURNAL_RETENTION = 30 * 24 * 60 * 60
+
+# Purger metrics are kept in their own registry, so only they end up in the textfile
+METRICS_REGISTRY = CollectorRegistry(auto_describe=True)
+METRIC_RUN_DURATION = Gauge(
+    "purger_run_duration_seconds",
+    "Duration of the last purger run",
+    registry=METRICS_REGISTRY,
+)
+METRIC_RUN_TIMESTAMP = Gauge(
+    "purger_run_timestamp_seconds",
+    "Time the last purger run finished",
+    registry=METRICS_REGISTRY,
+)
+METRIC_RUN_SUCCESS = Gauge(
+    "purger_run_success",
+    "Whether the last purger run finished without an exception",
+    registry=METRICS_REGISTRY,
+)
+METRIC_CANDIDATES = Gauge(
+    "purger_presence_candidates",
+    "Number of users whose presence is fetched due to possible inactivity",
+    ["network"],
+    registry=METRICS_REGISTRY,
+)
+METRIC_CANDIDATES_REMAINING = Gauge(
+    "purger_presence_candidates_remaining",
+    "Number of candidates whose presence has not been fetched yet in the current run",
+    ["network"],
+    registry=METRICS_REGISTRY,
+)
+METRIC_PRESENCE_LATENCY = Histogram(
+    "purger_presence_fetch_seconds",
+    "Latency of presence requests",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    registry=METRICS_REGISTRY,
+)
+METRIC_API_ERRORS = Counter(
+    "purger_api_errors",
+    "Number of failed requests, by endpoint",
+    ["endpoint"],
+    registry=METRICS_REGISTRY,
+)
+METRIC_DEACTIVATIONS = Counter(
+    "purger_deactivations",
+    "Number of user deactivations in the current run, by result",
+    ["network", "result"],
+    registry=METRICS_REGISTRY,
+)
+METRIC_STORE_USERS = Gauge(
+    "purger_user_activity_store_users",
+    "Number of users in the user activity store",
+    ["network"],
+    registry=METRICS_REGISTRY,
+)
+METRIC_JOURNAL_ENTRIES = Gauge(
+    "purger_journal_entries",
+    "Number of purge journal entries, by status",
+    ["status"],
+    registry=METRICS_REGISTRY,
+)
+DEFAULT_PRESENCE_CONCURRENCY = 4
+DEFAULT_PRESENCE_RATE = 10.0  # requests per second
+
+# Last activity of all local, non-deactivated members of a room in one query.
+# A user counts as active on their latest presence change, client sync or
+# request (``user_ips``), all of which are stored as millisecond timestamps.
+USER_ACTIVITY_QUERY = """
+SELECT
+    m.user_id,
+    GREATEST(p.last_active_ts, p.last_user_sync_ts, ip.last_seen) AS last_active_ts,
+    COALESCE(p.state, 'offline') AS presence
+FROM local_current_membership AS m
+JOIN users AS u ON u.name = m.user_id
+LEFT JOIN presence_stream AS p ON p.user_id = m.user_id
+LEFT JOIN LATERAL (
+    SELECT MAX(last_seen) AS last_seen FROM user_ips WHERE user_ips.user_id = m.user_id
+) AS ip ON TRUE
+WHERE m.room_id = %(room_id)s
+    AND m.membership = 'join'
+    AND u.deactivated = 0
+    AND m.user_id NOT LIKE '@admin%%'
+"""
+
+# Membership changes of a room since a ``current_state_delta_stream`` position.
+# A missing event id means the membership state was removed, which counts as leave.
+MEMBERSHIP_DELTA_QUERY = """
+SELECT d.stream_id, d.state_key, COALESCE(rm.membership, 'leave') AS membership
+FROM current_state_delta_stream AS d
+LEFT JOIN room_memberships AS rm ON rm.event_id = d.event_id
+WHERE d.room_id = %(room_id)s
+    AND d.type = 'm.room.member'
+    AND d.stream_id > %(stream_id)s
+ORDER BY d.stream_id
+"""
+CURRENT_STATE_DELTA_POSITION_QUERY = """
+SELECT COALESCE(MAX(stream_id), 0) FROM current_state_delta_stream
+"""
 
 
 class UserActivityInfo(TypedDict):
@@ -30,6 +171,21 @@ class UserActivityInfo(TypedDict):
     network_to_users: Dict[str, Dict[str, Any]]
 
 
+class ContainerWhitelistInfo(TypedDict):
+    started_at: str
+    whitelist_hash: str
+
+
+class WhitelistCache(TypedDict):
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    whitelist: List[str]
+    whitelist_hash: str
+    # container id -> whitelist the container has been running with since it was started
+    containers: Dict[str, ContainerWhitelistInfo]
+
+
 @dataclass(frozen=True)
 class RoomInfo:
     room_id: str
@@ -41,6 +197,503 @@ class RoomInfo:
         return f"#{self.alias}:{self.server_name}"
 
 
+@dataclass(frozen=True)
+class MembershipDelta:
+    # user id -> latest membership since the last sync
+    memberships: Dict[str, str]
+    # position to continue the next sync from
+    position: str
+
+
+class TokenBucket:
+    """Rate limiter shared by all greenlets of a presence fetching pass
+
+    Tokens are refilled continuously at ``rate`` per second, up to ``capacity``.
+    ``acquire`` blocks the calling greenlet until a token is available.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self) -> None:
+        self._refill()
+        while self._tokens < 1:
+            gevent.sleep((1 - self._tokens) / self.rate)
+            self._refill()
+        self._tokens -= 1
+
+
+class UserActivityStore(ABC):
+    """Last seen timestamps of local users, per network"""
+
+    @abstractmethod
+    def get_last_update(self) -> int:
+        """Time of the last discovery room member fetch"""
+
+    @abstractmethod
+    def set_last_update(self, last_update: int) -> None:
+        pass
+
+    @abstractmethod
+    def get_metadata(self, key: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def set_metadata(self, key: str, value: str) -> None:
+        pass
+
+    @abstractmethod
+    def networks(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def add_network(self, network_key: str) -> None:
+        pass
+
+    @abstractmethod
+    def get_last_seen(self, network_key: str, user_id: str) -> Optional[int]:
+        pass
+
+    @abstractmethod
+    def set_last_seen(self, network_key: str, user_id: str, last_seen: int) -> None:
+        pass
+
+    @abstractmethod
+    def add_users(self, network_key: str, user_ids: Iterable[str], last_seen: int) -> None:
+        """Add users which are not known yet, existing users are left untouched"""
+
+    @abstractmethod
+    def remove_user(self, network_key: str, user_id: str) -> None:
+        pass
+
+    @abstractmethod
+    def get_overdue_users(self, network_key: str, deadline: int) -> List[str]:
+        """All users of the network which have not been seen since ``deadline``"""
+
+    @abstractmethod
+    def count_users(self, network_key: Optional[str] = None) -> int:
+        pass
+
+    def flush(self) -> None:
+        """Persist all pending changes"""
+
+    def close(self) -> None:
+        self.flush()
+
+
+class InMemoryUserActivityStore(UserActivityStore):
+    """Keeps the user activity in a ``UserActivityInfo`` dict, the format of the former
+    ``user_activity.json``. Nothing is persisted.
+    """
+
+    def __init__(self, user_activity_info: UserActivityInfo) -> None:
+        self.user_activity_info = user_activity_info
+        self.metadata: Dict[str, str] = dict()
+
+    def get_last_update(self) -> int:
+        return self.user_activity_info["last_update"]
+
+    def set_last_update(self, last_update: int) -> None:
+        self.user_activity_info["last_update"] = last_update
+
+    def get_metadata(self, key: str) -> Optional[str]:
+        return self.metadata.get(key)
+
+    def set_metadata(self, key: str, value: str) -> None:
+        self.metadata[key] = value
+
+    def networks(self) -> List[str]:
+        return list(self.user_activity_info["network_to_users"].keys())
+
+    def add_network(self, network_key: str) -> None:
+        self.user_activity_info["network_to_users"].setdefault(network_key, dict())
+
+    def get_last_seen(self, network_key: str, user_id: str) -> Optional[int]:
+        return self.user_activity_info["network_to_users"][network_key].get(user_id)
+
+    def set_last_seen(self, network_key: str, user_id: str, last_seen: int) -> None:
+        self.user_activity_info["network_to_users"][network_key][user_id] = last_seen
+
+    def add_users(self, network_key: str, user_ids: Iterable[str], last_seen: int) -> None:
+        user_activity = self.user_activity_info["network_to_users"][network_key]
+        for user_id in user_ids:
+            user_activity.setdefault(user_id, last_seen)
+
+    def remove_user(self, network_key: str, user_id: str) -> None:
+        self.user_activity_info["network_to_users"][network_key].pop(user_id, None)
+
+    def get_overdue_users(self, network_key: str, deadline: int) -> List[str]:
+        return [
+            user_id
+            for user_id, last_seen in self.user_activity_info["network_to_users"][
+                network_key
+            ].items()
+            if last_seen < deadline
+        ]
+
+    def count_users(self, network_key: Optional[str] = None) -> int:
+        network_to_users = self.user_activity_info["network_to_users"]
+        if network_key is not None:
+            return len(network_to_users.get(network_key, {}))
+        return sum(len(users) for users in network_to_users.values())
+
+
+class SqliteUserActivityStore(UserActivityStore):
+    """SQLite backed user activity store
+
+    Changes are committed in batches of ``commit_batch_size`` while a run is in
+    progress, so a crash only loses the last uncommitted batch.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS network (
+            network TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS user_activity (
+            network TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            last_seen INTEGER NOT NULL,
+            PRIMARY KEY (network, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS user_activity_network_last_seen
+            ON user_activity (network, last_seen);
+    """
+
+    def __init__(self, path: str, commit_batch_size: int = DEFAULT_COMMIT_BATCH_SIZE) -> None:
+        self.commit_batch_size = commit_batch_size
+        self._pending_changes = 0
+        self.conn = sqlite3.connect(path)
+        if path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+
+    def _changed(self, count: int = 1) -> None:
+        self._pending_changes += count
+        if self._pending_changes >= self.commit_batch_size:
+            self.flush()
+
+    def get_last_update(self) -> int:
+        last_update = self.get_metadata("last_update")
+        if last_update is None:
+            # no update yet, trigger fetching the members
+            return int(time.time()) - USER_PURGING_THRESHOLD - 1
+        return int(last_update)
+
+    def set_last_update(self, last_update: int) -> None:
+        self.set_metadata("last_update", str(last_update))
+
+    def get_metadata(self, key: str) -> Optional[str]:
+        row = self.conn.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_metadata(self, key: str, value: str) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", (key, value)
+        )
+        self._changed()
+
+    def networks(self) -> List[str]:
+        return [row[0] for row in self.conn.execute("SELECT network FROM network")]
+
+    def add_network(self, network_key: str) -> None:
+        self.conn.execute("INSERT OR IGNORE INTO network (network) VALUES (?)", (network_key,))
+        self._changed()
+
+    def get_last_seen(self, network_key: str, user_id: str) -> Optional[int]:
+        row = self.conn.execute(
+            "SELECT last_seen FROM user_activity WHERE network = ? AND user_id = ?",
+            (network_key, user_id),
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_last_seen(self, network_key: str, user_id: str, last_seen: int) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO user_activity (network, user_id, last_seen) VALUES (?, ?, ?)",
+            (network_key, user_id, last_seen),
+        )
+        self._changed()
+
+    def add_users(self, network_key: str, user_ids: Iterable[str], last_seen: int) -> None:
+        cursor = self.conn.executemany(
+            "INSERT OR IGNORE INTO user_activity (network, user_id, last_seen) VALUES (?, ?, ?)",
+            ((network_key, user_id, last_seen) for user_id in user_ids),
+        )
+        self._changed(max(cursor.rowcount, 1))
+
+    def remove_user(self, network_key: str, user_id: str) -> None:
+        self.conn.execute(
+            "DELETE FROM user_activity WHERE network = ? AND user_id = ?", (network_key, user_id)
+        )
+        self._changed()
+
+    def get_overdue_users(self, network_key: str, deadline: int) -> List[str]:
+        return [
+            row[0]
+            for row in self.conn.execute(
+                "SELECT user_id FROM user_activity WHERE network = ? AND last_seen < ?",
+                (network_key, deadline),
+            )
+        ]
+
+    def count_users(self, network_key: Optional[str] = None) -> int:
+        if network_key is not None:
+            row = self.conn.execute(
+                "SELECT COUNT(*) FROM user_activity WHERE network = ?", (network_key,)
+            ).fetchone()
+        else:
+            row = self.conn.execute("SELECT COUNT(*) FROM user_activity").fetchone()
+        return row[0]
+
+    def flush(self) -> None:
+        self.conn.commit()
+        self._pending_changes = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
+
+
+def migrate_user_activity_file(store: UserActivityStore, path: Path) -> None:
+    """One-time import of a ``user_activity.json`` file into ``store``
+
+    The file is renamed afterwards, so it won't be imported again.
+    """
+    if not path.exists():
+        return
+
+    try:
+        user_activity_info: UserActivityInfo = json.loads(path.read_text())
+        store.set_last_update(user_activity_info["last_update"])
+        for network_key, user_activity in user_activity_info["network_to_users"].items():
+            store.add_network(network_key)
+            for user_id, last_seen in user_activity.items():
+                store.set_last_seen(network_key, user_id, last_seen)
+        store.flush()
+    except (JSONDecodeError, KeyError, TypeError) as ex:
+        click.secho(f"{path} is not a valid user activity file: {ex}. Not migrating it.")
+        return
+
+    migrated_path = path.with_name(f"{path.name}.migrated")
+    path.rename(migrated_path)
+    click.secho(f"Migrated {store.count_users()} users from {path} to {migrated_path}")
+
+
+class PurgeJournal(ABC):
+    """Deactivations which are pending, done or failed, per network
+
+    Entries survive a crashed or killed run, so the next run resumes the pending
+    deactivations. Failed deactivations are retried with an exponential backoff
+    until ``PURGE_MAX_ATTEMPTS`` is reached.
+    """
+
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+
+    @abstractmethod
+    def add_pending(self, network_key: str, user_ids: Iterable[str], now: int) -> None:
+        """Add users which have no journal entry yet as pending"""
+
+    @abstractmethod
+    def get_due(self, network_key: str, now: int, limit: int) -> List[str]:
+        """Pending users and failed users whose retry is due, oldest first"""
+
+    @abstractmethod
+    def mark_done(self, network_key: str, user_id: str, now: int) -> None:
+        pass
+
+    @abstractmethod
+    def mark_failed(self, network_key: str, user_id: str, error: str, now: int) -> None:
+        pass
+
+    @abstractmethod
+    def remove(self, network_key: str, user_id: str) -> None:
+        pass
+
+    @abstractmethod
+    def count(self, status: str) -> int:
+        pass
+
+    @abstractmethod
+    def prune(self, before: int) -> None:
+        """Remove done and finally failed entries last updated before ``before``"""
+
+    @staticmethod
+    def next_attempt(attempts: int, now: int) -> int:
+        return now + PURGE_RETRY_BACKOFF * 2 ** (attempts - 1)
+
+
+@dataclass
+class PurgeJournalEntry:
+    status: str
+    attempts: int
+    next_attempt: int
+    updated: int
+    last_error: Optional[str] = None
+
+
+class InMemoryPurgeJournal(PurgeJournal):
+    def __init__(self) -> None:
+        self.entries: Dict[Tuple[str, str], PurgeJournalEntry] = dict()
+
+    def add_pending(self, network_key: str, user_ids: Iterable[str], now: int) -> None:
+        for user_id in user_ids:
+            self.entries.setdefault(
+                (network_key, user_id), PurgeJournalEntry(self.PENDING, 0, now, now)
+            )
+
+    def get_due(self, network_key: str, now: int, limit: int) -> List[str]:
+        due = sorted(
+            (entry.next_attempt, user_id)
+            for (entry_network_key, user_id), entry in self.entries.items()
+            if entry_network_key == network_key
+            and entry.status in (self.PENDING, self.FAILED)
+            and entry.attempts < PURGE_MAX_ATTEMPTS
+            and entry.next_attempt <= now
+        )
+        return [user_id for _, user_id in due[:limit]]
+
+    def mark_done(self, network_key: str, user_id: str, now: int) -> None:
+        entry = self.entries[(network_key, user_id)]
+        entry.status = self.DONE
+        entry.updated = now
+
+    def mark_failed(self, network_key: str, user_id: str, error: str, now: int) -> None:
+        entry = self.entries[(network_key, user_id)]
+        entry.status = self.FAILED
+        entry.attempts += 1
+        entry.next_attempt = self.next_attempt(entry.attempts, now)
+        entry.updated = now
+        entry.last_error = error
+
+    def remove(self, network_key: str, user_id: str) -> None:
+        self.entries.pop((network_key, user_id), None)
+
+    def count(self, status: str) -> int:
+        return sum(1 for entry in self.entries.values() if entry.status == status)
+
+    def prune(self, before: int) -> None:
+        self.entries = {
+            key: entry
+            for key, entry in self.entries.items()
+            if entry.updated >= before
+            or entry.status == self.PENDING
+            or (entry.status == self.FAILED and entry.attempts < PURGE_MAX_ATTEMPTS)
+        }
+
+
+class SqlitePurgeJournal(PurgeJournal):
+    """Purge journal in SQLite, every state change is committed immediately
+
+    The journal shares the connection of the user activity store, since both live
+    in the same database file.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS purge_journal (
+            network TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt INTEGER NOT NULL,
+            updated INTEGER NOT NULL,
+            last_error TEXT,
+            PRIMARY KEY (network, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS purge_journal_network_status_next_attempt
+            ON purge_journal (network, status, next_attempt);
+    """
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+
+    def add_pending(self, network_key: str, user_ids: Iterable[str], now: int) -> None:
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO purge_journal "
+                "(network, user_id, status, next_attempt, updated) VALUES (?, ?, ?, ?, ?)",
+                ((network_key, user_id, self.PENDING, now, now) for user_id in user_ids),
+            )
+
+    def get_due(self, network_key: str, now: int, limit: int) -> List[str]:
+        return [
+            row[0]
+            for row in self.conn.execute(
+                "SELECT user_id FROM purge_journal "
+                "WHERE network = ? AND status IN (?, ?) AND attempts < ? AND next_attempt <= ? "
+                "ORDER BY next_attempt LIMIT ?",
+                (network_key, self.PENDING, self.FAILED, PURGE_MAX_ATTEMPTS, now, limit),
+            )
+        ]
+
+    def mark_done(self, network_key: str, user_id: str, now: int) -> None:
+        with self.conn:
+            self.conn.execute(
+                "UPDATE purge_journal SET status = ?, updated = ? "
+                "WHERE network = ? AND user_id = ?",
+                (self.DONE, now, network_key, user_id),
+            )
+
+    def mark_failed(self, network_key: str, user_id: str, error: str, now: int) -> None:
+        row = self.conn.execute(
+            "SELECT attempts FROM purge_journal WHERE network = ? AND user_id = ?",
+            (network_key, user_id),
+        ).fetchone()
+        attempts = (row[0] if row is not None else 0) + 1
+        with self.conn:
+            self.conn.execute(
+                "UPDATE purge_journal "
+                "SET status = ?, attempts = ?, next_attempt = ?, updated = ?, last_error = ? "
+                "WHERE network = ? AND user_id = ?",
+                (
+                    self.FAILED,
+                    attempts,
+                    self.next_attempt(attempts, now),
+                    now,
+                    error,
+                    network_key,
+                    user_id,
+                ),
+            )
+
+    def remove(self, network_key: str, user_id: str) -> None:
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM purge_journal WHERE network = ? AND user_id = ?",
+                (network_key, user_id),
+            )
+
+    def count(self, status: str) -> int:
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM purge_journal WHERE status = ?", (status,)
+        ).fetchone()[0]
+
+    def prune(self, before: int) -> None:
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM purge_journal WHERE updated < ? "
+                "AND (status = ? OR (status = ? AND attempts >= ?))",
+                (before, self.DONE, self.FAILED, PURGE_MAX_ATTEMPTS),
+            )
+
+
 @click.command()
 @click.argument("server")
 @click.option("-c", "--credentials-file", required=True, type=click.File("rt"))
@@ -54,11 +707,82 @@ class RoomInfo:
     envvar="URL_KNOWN_FEDERATION_SERVERS",
     default=DEFAULT_MATRIX_KNOWN_SERVERS[Environment.PRODUCTION],
 )
+@click.option(
+    "--presence-concurrency",
+    type=click.IntRange(min=1),
+    default=DEFAULT_PRESENCE_CONCURRENCY,
+    show_default=True,
+    help="Number of presence requests which are allowed to be in flight at the same time.",
+)
+@click.option(
+    "--presence-rate",
+    type=click.FloatRange(min=0.01),
+    default=DEFAULT_PRESENCE_RATE,
+    show_default=True,
+    help="Maximum number of presence requests per second.",
+)
+@click.option(
+    "--synapse-db-dsn",
+    help="If set, read the last activity of discovery room members directly from the "
+    "synapse database, e.g. 'postgresql://postgres@db/synapse'. Users which can't be "
+    "found there are still looked up through the presence API.",
+)
+@click.option(
+    "--user-activity-db",
+    type=click.Path(dir_okay=False),
+    default=str(USER_ACTIVITY_DB_PATH),
+    show_default=True,
+    help="SQLite database the user activity is stored in. An existing "
+    f"{USER_ACTIVITY_PATH.name} next to it is imported on the first run.",
+)
+@click.option(
+    "--member-sync",
+    type=click.Choice([MEMBER_SYNC_INCREMENTAL, MEMBER_SYNC_FULL]),
+    default=MEMBER_SYNC_INCREMENTAL,
+    show_default=True,
+    help="Either only process discovery room membership changes since the last run, or "
+    "download the complete member list every time.",
+)
+@click.option(
+    "--purge-concurrency",
+    type=click.IntRange(min=1),
+    default=DEFAULT_PURGE_CONCURRENCY,
+    show_default=True,
+    help="Number of user deactivations which are allowed to run at the same time.",
+)
+@click.option(
+    "--max-purges-per-run",
+    type=click.IntRange(min=0),
+    default=DEFAULT_MAX_PURGES_PER_RUN,
+    show_default=True,
+    help="Maximum number of users deactivated in one run. Remaining users are kept in the "
+    "purge journal and deactivated in the following runs.",
+)
+@click.option(
+    "--metrics-textfile",
+    type=click.Path(dir_okay=False),
+    help="If set, write the metrics of the run to this file when it's finished. Point it to "
+    "the textfile collector directory of node_exporter, e.g. '/textfile/purger.prom'.",
+)
+@click.option(
+    "--metrics-port",
+    type=click.IntRange(min=1, max=65535),
+    help="If set, serve the metrics on this port while the purger is running.",
+)
 def purge(
     server: str,
     credentials_file: TextIO,
     docker_restart_label: Optional[str],
     url_known_federation_servers: str,
+    presence_concurrency: int,
+    presence_rate: float,
+    synapse_db_dsn: Optional[str],
+    user_activity_db: str,
+    member_sync: str,
+    purge_concurrency: int,
+    max_purges_per_run: int,
+    metrics_textfile: Optional[str],
+    metrics_port: Optional[int],
 ) -> None:
     """Purge inactive users from broadcast rooms
 
@@ -67,97 +791,266 @@ def purge(
     All option can be passed through uppercase environment variables prefixed with 'MATRIX_'
     """
 
-    try:
-        credentials = json.loads(credentials_file.read())
-        username = credentials["username"]
-        password = credentials["password"]
-    except (JSONDecodeError, UnicodeDecodeError, OSError, KeyError) as ex:
-        click.secho(f"Invalid credentials file: {ex}", fg="red")
-        sys.exit(1)
-
-    api = GMatrixHttpApi(server)
-    try:
-        response = api.login(
-            "m.login.password", user=username, password=password, device_id="purger"
-        )
-        api.token = response["access_token"]
-    except (MatrixError, KeyError) as ex:
-        click.secho(f"Could not log in to server {server}: {ex}")
-        sys.exit(1)
+    started = time.monotonic()
+    if metrics_port:
+        start_http_server(metrics_port, registry=METRICS_REGISTRY)
 
+    succeeded = False
     try:
-        global_user_activity: UserActivityInfo = {
-            "last_update": int(time.time()) - USER_PURGING_THRESHOLD - 1,
-            "network_to_users": {},
-        }
-
         try:
-            global_user_activity = json.loads(USER_ACTIVITY_PATH.read_text())
-        except JSONDecodeError:
-            click.secho(f"{USER_ACTIVITY_PATH} is not a valid JSON. Starting with empty list")
-        except FileNotFoundError:
-            click.secho(f"{USER_ACTIVITY_PATH} not found. Starting with empty list")
-
-        # check if there are new networks to add
-        for network in Networks:
-            if str(network.value) in global_user_activity["network_to_users"]:
-                continue
-            global_user_activity["network_to_users"][str(network.value)] = dict()
+            credentials = json.loads(credentials_file.read())
+            username = credentials["username"]
+            password = credentials["password"]
+        except (JSONDecodeError, UnicodeDecodeError, OSError, KeyError) as ex:
+            click.secho(f"Invalid credentials file: {ex}", fg="red")
+            sys.exit(1)
 
-        new_global_user_activity = run_user_purger(api, global_user_activity)
+        api = GMatrixHttpApi(server, pool_maxsize=max(presence_concurrency, purge_concurrency))
+        try:
+            response = api.login(
+                "m.login.password", user=username, password=password, device_id="purger"
+            )
+            api.token = response["access_token"]
+        except (MatrixError, KeyError) as ex:
+            click.secho(f"Could not log in to server {server}: {ex}")
+            sys.exit(1)
 
-        # write the updated user activity to file
-        USER_ACTIVITY_PATH.write_text(json.dumps(cast(Dict[str, Any], new_global_user_activity)))
-    finally:
-        if docker_restart_label:
-            if not url_known_federation_servers:
-                # In case an empty env var is set
-                url_known_federation_servers = DEFAULT_MATRIX_KNOWN_SERVERS[Environment.PRODUCTION]
-            # fetch remote whiltelist
+        db_connection = None
+        if synapse_db_dsn:
+            if psycopg2 is None:
+                click.secho("--synapse-db-dsn requires psycopg2 to be installed", fg="red")
+                sys.exit(1)
             try:
-                remote_whitelist = json.loads(requests.get(url_known_federation_servers).text)[
-                    "all_servers"
-                ]
-            except (requests.RequestException, JSONDecodeError, KeyError) as ex:
+                db_connection = psycopg2.connect(synapse_db_dsn)
+                db_connection.set_session(readonly=True, autocommit=True)
+            except DatabaseError as ex:
                 click.secho(
-                    f"Error while fetching whitelist: {ex!r}. "
-                    f"Ignoring, containers will be restarted.",
-                    err=True,
+                    f"Could not connect to synapse database: {ex}. Falling back to presence API.",
+                    fg="yellow",
                 )
-                # An empty whitelist will cause the container to be restarted
-                remote_whitelist = []
-
-            client = docker.from_env()  # pylint: disable=no-member
-            for container in client.containers.list():
-                if container.attrs["State"]["Status"] != "running" or not container.attrs[
-                    "Config"
-                ]["Labels"].get(docker_restart_label):
-                    continue
-
-                try:
-                    # fetch local list from container's synapse config
-                    local_whitelist = yaml.safe_load(
-                        container.exec_run(["cat", SYNAPSE_CONFIG_PATH]).output
-                    )["federation_domain_whitelist"]
-
-                    # if list didn't change, don't proceed to restart container
-                    if local_whitelist and remote_whitelist == local_whitelist:
-                        continue
-
-                    click.secho(f"Whitelist changed. Restarting. new_list={remote_whitelist!r}")
-                except (KeyError, IndexError) as ex:
-                    click.secho(
-                        f"Error fetching container status: {ex!r}. Restarting anyway.",
-                        err=True,
-                    )
-                # restart container
-                container.restart(timeout=30)
+
+        store = SqliteUserActivityStore(user_activity_db)
+        journal = SqlitePurgeJournal(store.conn)
+        try:
+            migrate_user_activity_file(
+                store, Path(user_activity_db).with_name(USER_ACTIVITY_PATH.name)
+            )
+
+            # check if there are new networks to add
+            for network in Networks:
+                store.add_network(str(network.value))
+
+            run_user_purger(
+                api,
+                store,
+                presence_concurrency=presence_concurrency,
+                presence_rate=presence_rate,
+                db_connection=db_connection,
+                member_sync=member_sync,
+                journal=journal,
+                purge_concurrency=purge_concurrency,
+                max_purges_per_run=max_purges_per_run,
+            )
+            succeeded = True
+        finally:
+            store.close()
+            if db_connection is not None:
+                db_connection.close()
+
+            if docker_restart_label:
+                if not url_known_federation_servers:
+                    # In case an empty env var is set
+                    url_known_federation_servers = DEFAULT_MATRIX_KNOWN_SERVERS[
+                        Environment.PRODUCTION
+                    ]
+                whitelist_cache_path = Path(user_activity_db).with_name(WHITELIST_CACHE_FILENAME)
+                whitelist_cache = load_whitelist_cache(whitelist_cache_path)
+
+                remote_whitelist = fetch_federation_whitelist(
+                    url_known_federation_servers, whitelist_cache
+                )
+                if remote_whitelist is None:
+                    click.secho("No federation whitelist available, not restarting.", err=True)
+                else:
+                    client = docker.from_env()  # pylint: disable=no-member
+                    restart_outdated_containers(client, docker_restart_label, whitelist_cache)
+
+                whitelist_cache_path.write_text(json.dumps(whitelist_cache))
+    finally:
+        # written last, to include the whitelist fetch and container restarts
+        METRIC_RUN_DURATION.set(time.monotonic() - started)
+        METRIC_RUN_TIMESTAMP.set_to_current_time()
+        METRIC_RUN_SUCCESS.set(int(succeeded))
+        if metrics_textfile:
+            write_to_textfile(metrics_textfile, METRICS_REGISTRY)
+
+
+def whitelist_hash(whitelist: List[str]) -> str:
+    # Has to match ``whitelist_hash`` in build/synapse/render_config_template.py
+    return hashlib.sha256(json.dumps(whitelist).encode()).hexdigest()
+
+
+def load_whitelist_cache(path: Path) -> WhitelistCache:
+    try:
+        return json.loads(path.read_text())
+    except (OSError, JSONDecodeError):
+        return {
+            "url": "",
+            "etag": None,
+            "last_modified": None,
+            "whitelist": [],
+            "whitelist_hash": "",
+            "containers": {},
+        }
+
+
+def fetch_federation_whitelist(url: str, cache: WhitelistCache) -> Optional[List[str]]:
+    """
+    Fetches the federation whitelist, using the cache for conditional requests.
+    The cache is updated in place.
+
+    :return: the current whitelist, the last known good one if fetching fails, or
+        ``None`` if there is no whitelist at all
+    """
+    headers = dict()
+    if cache["url"] == url and cache["whitelist"]:
+        if cache["etag"]:
+            headers["If-None-Match"] = cache["etag"]
+        if cache["last_modified"]:
+            headers["If-Modified-Since"] = cache["last_modified"]
+
+    try:
+        response = requests.get(url, headers=headers, timeout=WHITELIST_FETCH_TIMEOUT)
+        if response.status_code == 304:
+            return cache["whitelist"]
+        response.raise_for_status()
+        whitelist = response.json()["all_servers"]
+        if not isinstance(whitelist, list) or not whitelist:
+            raise ValueError(f"Invalid whitelist: {whitelist!r}")
+    except (requests.RequestException, ValueError, KeyError) as ex:
+        METRIC_API_ERRORS.labels(endpoint="whitelist").inc()
+        if cache["url"] == url and cache["whitelist"]:
+            click.secho(f"Error while fetching whitelist: {ex!r}. Using cached one.", err=True)
+            return cache["whitelist"]
+        click.secho(f"Error while fetching whitelist: {ex!r}.", err=True)
+        return None
+
+    cache["url"] = url
+    cache["etag"] = response.headers.get("ETag")
+    cache["last_modified"] = response.headers.get("Last-Modified")
+    cache["whitelist"] = whitelist
+    cache["whitelist_hash"] = whitelist_hash(whitelist)
+    return whitelist
+
+
+def _read_container_whitelist_hash(container: Any) -> Optional[str]:
+    result = container.exec_run(["cat", SYNAPSE_WHITELIST_HASH_PATH])
+    if result.exit_code != 0:
+        click.secho(f"Error fetching container status: {result.output!r}.", err=True)
+        return None
+    return result.output.decode().strip() or None
+
+
+def _wait_until_healthy(container: Any, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while True:
+        container.reload()
+        state = container.attrs["State"]
+        if "Health" not in state:
+            # without a health check, running is the best we can get
+            return state["Status"] == "running"
+        if state["Health"]["Status"] == "healthy":
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        gevent.sleep(CONTAINER_HEALTH_POLL_INTERVAL)
+
+
+def _restart_if_outdated(
+    containers: List[Any],
+    known_containers: Dict[str, ContainerWhitelistInfo],
+    cache: WhitelistCache,
+) -> List[Any]:
+    restarted = list()
+    for container in containers:
+        started_at = container.attrs["State"]["StartedAt"]
+        known_container = known_containers.get(container.id)
+        if known_container is not None and known_container["started_at"] == started_at:
+            local_hash: Optional[str] = known_container["whitelist_hash"]
+        else:
+            local_hash = _read_container_whitelist_hash(container)
+
+        # if list didn't change, don't proceed to restart container
+        if local_hash == cache["whitelist_hash"]:
+            cache["containers"][container.id] = {
+                "started_at": started_at,
+                "whitelist_hash": cache["whitelist_hash"],
+            }
+            continue
+
+        click.secho(
+            f"Whitelist of {container.name} changed. Restarting. new_list={cache['whitelist']!r}"
+        )
+        # the whitelist of the restarted container is checked again on the next run
+        container.restart(timeout=30)
+        restarted.append(container)
+    return restarted
+
+
+def restart_outdated_containers(
+    client: Any,
+    label: str,
+    cache: WhitelistCache,
+    health_timeout: float = CONTAINER_HEALTH_TIMEOUT,
+) -> None:
+    """
+    Restarts all running containers with the given label whose whitelist differs from the
+    cached one.
+
+    Every container stores the hash of the whitelist it was started with. It is only read
+    once after the container has been (re)started, after that the hash stored in the cache
+    is compared.
+
+    Containers labelled with ``RESTART_LABEL_WORKER`` load the config rendered by the
+    synapse main process. They are only restarted once all other restarted containers
+    are healthy again, so they pick up the new config.
+    """
+    known_containers = cache["containers"]
+    cache["containers"] = dict()
+    containers = [
+        container
+        for container in client.containers.list()
+        if container.attrs["State"]["Status"] == "running"
+        and container.attrs["Config"]["Labels"].get(label)
+    ]
+    workers = [
+        container
+        for container in containers
+        if container.attrs["Config"]["Labels"][label] == RESTART_LABEL_WORKER
+    ]
+    others = [container for container in containers if container not in workers]
+
+    restarted = _restart_if_outdated(others, known_containers, cache)
+    if not all(_wait_until_healthy(container, health_timeout) for container in restarted):
+        click.secho("Restarted containers aren't healthy, not restarting workers.", err=True)
+        for worker in workers:
+            if worker.id in known_containers:
+                cache["containers"][worker.id] = known_containers[worker.id]
+        return
+    _restart_if_outdated(workers, known_containers, cache)
 
 
 def run_user_purger(
     api: GMatrixHttpApi,
-    global_user_activity: UserActivityInfo,
-) -> UserActivityInfo:
+    store: UserActivityStore,
+    presence_concurrency: int = DEFAULT_PRESENCE_CONCURRENCY,
+    presence_rate: float = DEFAULT_PRESENCE_RATE,
+    db_connection: Optional[Any] = None,
+    member_sync: str = MEMBER_SYNC_INCREMENTAL,
+    journal: Optional[PurgeJournal] = None,
+    purge_concurrency: int = DEFAULT_PURGE_CONCURRENCY,
+    max_purges_per_run: int = DEFAULT_MAX_PURGES_PER_RUN,
+) -> None:
     """
     The user purger mechanism finds inactive users which have been offline
     longer than the threshold time and will delete them. By deactivating them
@@ -166,37 +1059,70 @@ def run_user_purger(
     Each server is responsible for its own users
 
     :param api: Api object to own server
-    :param global_user_activity: content of user activity file
-    :return: updated list of user activities
+    :param store: user activity store, updated in place
+    :param presence_concurrency: number of concurrent presence requests
+    :param presence_rate: maximum number of presence requests per second
+    :param db_connection: optional connection to the synapse database
+    :param member_sync: either ``MEMBER_SYNC_INCREMENTAL`` or ``MEMBER_SYNC_FULL``
+    :param journal: purge journal to resume deactivations from, kept in memory if not given
+    :param purge_concurrency: number of concurrent deactivations
+    :param max_purges_per_run: maximum number of deactivations in this run
     """
 
     # perform update on user presence for due users
     # receive a list for due users on each network
-    due_users = update_user_activity(api, global_user_activity)
+    due_users = update_user_activity(
+        api,
+        store,
+        presence_concurrency=presence_concurrency,
+        presence_rate=presence_rate,
+        db_connection=db_connection,
+        member_sync=member_sync,
+    )
     # purge due users form rooms
-    purge_inactive_users(api, global_user_activity, due_users)
+    purge_inactive_users(
+        api,
+        store,
+        due_users,
+        journal=journal if journal is not None else InMemoryPurgeJournal(),
+        concurrency=purge_concurrency,
+        max_purges=max_purges_per_run,
+    )
+    store.flush()
 
-    return global_user_activity
+    for network_key in store.networks():
+        METRIC_STORE_USERS.labels(network=network_key).set(store.count_users(network_key))
 
 
 def update_user_activity(
     api: GMatrixHttpApi,
-    global_user_activity: UserActivityInfo,
+    store: UserActivityStore,
+    presence_concurrency: int = DEFAULT_PRESENCE_CONCURRENCY,
+    presence_rate: float = DEFAULT_PRESENCE_RATE,
+    db_connection: Optional[Any] = None,
+    member_sync: str = MEMBER_SYNC_INCREMENTAL,
 ) -> Dict[str, List[str]]:
     """
     runs update on users' presences which are about to be deleted.
     If they are still overdue they are going to be added to the list
     of users to be deleted. Presence updates are included in the
-    global list which is going to be stored in the user_activity_file
+    user activity store
     :param api: api to its own server
-    :param global_user_activity: content of user_activity_file
+    :param store: user activity store
+    :param presence_concurrency: number of concurrent presence requests
+    :param presence_rate: maximum number of presence requests per second
+    :param db_connection: optional connection to the synapse database. If given,
+        the activity of all discovery room members is read from there and the
+        presence API is only used for users the database doesn't know about.
+    :param member_sync: either ``MEMBER_SYNC_INCREMENTAL`` or ``MEMBER_SYNC_FULL``
     :return: a list of due users to be deleted
     """
     current_time = int(time.time())
-    last_user_activity_update = global_user_activity["last_update"]
-    network_to_users = global_user_activity["network_to_users"]
+    last_user_activity_update = store.get_last_update()
     network_to_due_users = dict()
     fetch_new_members = False
+    # the rate limit is global for the server, not per network
+    rate_limiter = TokenBucket(presence_rate)
 
     # check if new members have to be fetched
     # new members only have to be fetched every
@@ -205,25 +1131,56 @@ def update_user_activity(
     # the server as low as possible
     if last_user_activity_update < current_time - USER_PURGING_THRESHOLD:
         fetch_new_members = True
-        global_user_activity["last_update"] = current_time
+        store.set_last_update(current_time)
 
-    for network_key, user_activity in network_to_users.items():
-        if fetch_new_members:
+    for network_key in store.networks():
+        discovery_room = None
+        if fetch_new_members or db_connection is not None:
             discovery_room = get_discovery_room(api, int(network_key))
+
+        if fetch_new_members:
             if discovery_room is None:
                 click.secho(
                     f"No discovery room found for network {network_key}, skipping.", fg="yellow"
                 )
                 continue
-            _fetch_new_members_for_network(
-                api=api,
-                user_activity=user_activity,
+            if member_sync == MEMBER_SYNC_INCREMENTAL:
+                _sync_members_for_network(
+                    api=api,
+                    store=store,
+                    network_key=network_key,
+                    discovery_room=discovery_room,
+                    current_time=current_time,
+                    db_connection=db_connection,
+                )
+            else:
+                _fetch_new_members_for_network(
+                    api=api,
+                    store=store,
+                    network_key=network_key,
+                    discovery_room=discovery_room,
+                    current_time=current_time,
+                )
+
+        database_due_users: List[str] = []
+        database_users: Set[str] = set()
+        if db_connection is not None and discovery_room is not None:
+            database_due_users, database_users = _update_user_activity_from_database(
+                db_connection=db_connection,
+                store=store,
+                network_key=network_key,
                 discovery_room=discovery_room,
                 current_time=current_time,
             )
 
-        network_to_due_users[network_key] = _update_user_activity_for_network(
-            api=api, user_activity=user_activity, current_time=current_time
+        network_to_due_users[network_key] = database_due_users + _update_user_activity_for_network(
+            api=api,
+            store=store,
+            network_key=network_key,
+            current_time=current_time,
+            rate_limiter=rate_limiter,
+            concurrency=presence_concurrency,
+            skip_users=database_users,
         )
 
     return network_to_due_users
@@ -239,57 +1196,239 @@ def get_discovery_room(api: GMatrixHttpApi, network_value: int) -> Optional[Room
         room_id = api.get_room_id(local_room_alias)
         return RoomInfo(room_id, discovery_room_alias, server)
     except MatrixError as ex:
+        METRIC_API_ERRORS.labels(endpoint="room_alias").inc()
         click.secho(f"Could not find room {discovery_room_alias} with error {ex}")
 
     return None
 
 
 def _fetch_new_members_for_network(
-    api: GMatrixHttpApi, user_activity: Dict[str, int], discovery_room: RoomInfo, current_time: int
-) -> None:
+    api: GMatrixHttpApi,
+    store: UserActivityStore,
+    network_key: str,
+    discovery_room: RoomInfo,
+    current_time: int,
+) -> bool:
     try:
         response = api._send(
             "GET",
             api_path="/_synapse/admin/v1",
             path=f"/rooms/{discovery_room.room_id}/members",
         )
-        server_name = urlparse(api.base_url).netloc
-        room_members = [
-            member
-            for member in response["members"]
-            if member.split(":")[1] == server_name and not member.startswith("@admin")
-        ]
+        server_suffix = f":{urlparse(api.base_url).netloc}"
+        room_members = (
+            member for member in response["members"] if _is_purgeable_user(member, server_suffix)
+        )
 
         # Add new members with an overdue activity time
         # to trigger presence update later
-        for user_id in room_members:
-            if user_id not in user_activity:
-                user_activity[user_id] = current_time - USER_PURGING_THRESHOLD - 1
+        store.add_users(network_key, room_members, current_time - USER_PURGING_THRESHOLD - 1)
+        return True
 
     except MatrixError as ex:
+        METRIC_API_ERRORS.labels(endpoint="members").inc()
         click.secho(f"Could not fetch members for {discovery_room.alias} with error {ex}")
+        return False
+
+
+def _is_purgeable_user(user_id: str, server_suffix: str) -> bool:
+    return user_id.endswith(server_suffix) and not user_id.startswith("@admin")
+
+
+def _sync_members_for_network(
+    api: GMatrixHttpApi,
+    store: UserActivityStore,
+    network_key: str,
+    discovery_room: RoomInfo,
+    current_time: int,
+    db_connection: Optional[Any] = None,
+) -> None:
+    """
+    Applies the membership changes of the discovery room since the last sync: new members
+    are added to the store, members who left are removed from it.
+    If there is no sync position for the room yet, the full member list is fetched once.
+    """
+    source = "database" if db_connection is not None else "api"
+    position_key = f"member_sync_position:{source}:{discovery_room.room_id}"
+    since = store.get_metadata(position_key)
+
+    if since is None:
+        # take the position before fetching the members, so no change gets lost
+        position = _get_member_sync_position(api, discovery_room, db_connection)
+        fetched = _fetch_new_members_for_network(
+            api=api,
+            store=store,
+            network_key=network_key,
+            discovery_room=discovery_room,
+            current_time=current_time,
+        )
+        if fetched and position is not None:
+            store.set_metadata(position_key, position)
+        return
+
+    delta = _fetch_membership_delta(api, discovery_room, since, db_connection)
+    if delta is None:
+        return
+
+    server_suffix = f":{urlparse(api.base_url).netloc}"
+    joined = []
+    left = 0
+    for user_id, membership in delta.memberships.items():
+        if not _is_purgeable_user(user_id, server_suffix):
+            continue
+        if membership == "join":
+            joined.append(user_id)
+        elif membership in ("leave", "ban"):
+            store.remove_user(network_key, user_id)
+            left += 1
+    store.add_users(network_key, joined, current_time - USER_PURGING_THRESHOLD - 1)
+    store.set_metadata(position_key, delta.position)
+    click.secho(f"Synced members of {discovery_room.alias}: {len(joined)} joined, {left} left.")
+
+
+def _member_sync_endpoint(db_connection: Optional[Any]) -> str:
+    return "database" if db_connection is not None else "messages"
+
+
+def _get_member_sync_position(
+    api: GMatrixHttpApi, discovery_room: RoomInfo, db_connection: Optional[Any]
+) -> Optional[str]:
+    try:
+        if db_connection is not None:
+            with db_connection.cursor() as cursor:
+                cursor.execute(CURRENT_STATE_DELTA_POSITION_QUERY)
+                return str(cursor.fetchone()[0])
+
+        response = api._send(
+            "GET",
+            f"/rooms/{quote(discovery_room.room_id)}/messages",
+            query_params={"dir": "b", "limit": 1, "filter": MEMBER_EVENTS_FILTER},
+        )
+        return response["start"]
+    except (MatrixError, KeyError, DatabaseError) as ex:
+        METRIC_API_ERRORS.labels(endpoint=_member_sync_endpoint(db_connection)).inc()
+        click.secho(f"Could not get member sync position of {discovery_room.alias}: {ex!r}")
+    return None
+
+
+def _fetch_membership_delta(
+    api: GMatrixHttpApi, discovery_room: RoomInfo, since: str, db_connection: Optional[Any]
+) -> Optional[MembershipDelta]:
+    memberships: Dict[str, str] = dict()
+    try:
+        if db_connection is not None:
+            with db_connection.cursor() as cursor:
+                cursor.execute(
+                    MEMBERSHIP_DELTA_QUERY,
+                    {"room_id": discovery_room.room_id, "stream_id": int(since)},
+                )
+                position = int(since)
+                for stream_id, user_id, membership in cursor:
+                    memberships[user_id] = membership
+                    position = stream_id
+            return MembershipDelta(memberships, str(position))
+
+        position_token = since
+        while True:
+            response = api._send(
+                "GET",
+                f"/rooms/{quote(discovery_room.room_id)}/messages",
+                query_params={
+                    "from": position_token,
+                    "dir": "f",
+                    "limit": MEMBER_EVENTS_PAGE_SIZE,
+                    "filter": MEMBER_EVENTS_FILTER,
+                },
+            )
+            for event in response["chunk"]:
+                memberships[event["state_key"]] = event["content"].get("membership", "leave")
+            if not response["chunk"] or "end" not in response:
+                break
+            position_token = response["end"]
+        return MembershipDelta(memberships, position_token)
+    except (MatrixError, KeyError, DatabaseError) as ex:
+        METRIC_API_ERRORS.labels(endpoint=_member_sync_endpoint(db_connection)).inc()
+        click.secho(f"Could not fetch membership changes of {discovery_room.alias}: {ex!r}")
+    return None
+
+
+def _update_user_activity_from_database(
+    db_connection: Any,
+    store: UserActivityStore,
+    network_key: str,
+    discovery_room: RoomInfo,
+    current_time: int,
+) -> Tuple[List[str], Set[str]]:
+    """
+    Updates the activity of all local members of the discovery room from the synapse database.
+    New members are added to the store as well.
+
+    :return: due users and all users whose activity was found in the database.
+        Both are empty if the database could not be queried.
+    """
+    deadline = current_time - USER_PURGING_THRESHOLD
+    try:
+        with db_connection.cursor() as cursor:
+            cursor.execute(USER_ACTIVITY_QUERY, {"room_id": discovery_room.room_id})
+            rows: List[Tuple[str, Optional[int], str]] = cursor.fetchall()
+    except DatabaseError as ex:
+        METRIC_API_ERRORS.labels(endpoint="database").inc()
+        click.secho(
+            f"Could not query user activity for {discovery_room.alias} from database: {ex}. "
+            f"Falling back to presence API.",
+            fg="yellow",
+        )
+        return [], set()
+
+    due_users = list()
+    for user_id, last_active_ts, presence in rows:
+        if last_active_ts is None:
+            last_seen = deadline - 1
+        else:
+            last_seen = min(current_time, last_active_ts // 1000)
+        store.set_last_seen(network_key, user_id, last_seen)
+        if last_seen < deadline and presence == "offline":
+            due_users.append(user_id)
+
+    click.secho(
+        f"Fetched activity of {len(rows)} members of {discovery_room.alias} from database, "
+        f"{len(due_users)} are due."
+    )
+    return due_users, {user_id for user_id, _, _ in rows}
 
 
 def _update_user_activity_for_network(
-    api: GMatrixHttpApi, user_activity: Dict[str, int], current_time: int
+    api: GMatrixHttpApi,
+    store: UserActivityStore,
+    network_key: str,
+    current_time: int,
+    rate_limiter: TokenBucket,
+    concurrency: int = DEFAULT_PRESENCE_CONCURRENCY,
+    skip_users: Collection[str] = (),
 ) -> List[str]:
     deadline = current_time - USER_PURGING_THRESHOLD
 
     possible_candidates = [
-        user_id for user_id, last_seen in user_activity.items() if last_seen < deadline
+        user_id
+        for user_id in store.get_overdue_users(network_key, deadline)
+        if user_id not in skip_users
     ]
 
     due_users = list()
+    errors = 0
+    METRIC_CANDIDATES.labels(network=network_key).set(len(possible_candidates))
+    remaining = METRIC_CANDIDATES_REMAINING.labels(network=network_key)
+    remaining.set(len(possible_candidates))
     click.secho(
         f"Presences of {len(possible_candidates)} users will be fetched due to possible inactivity. This might take a while."
     )
-    # presence updates are only run for possible due users.
-    # This helps to spread the load on the server as good as possible
-    # Since this script runs once a day, every day a couple of users are
-    # going to be updated rather than all at once
-    for user_id in possible_candidates:
+
+    def fetch_presence(user_id: str) -> None:
+        nonlocal errors
+        rate_limiter.acquire()
         try:
-            response = api.get_presence(user_id)
+            with METRIC_PRESENCE_LATENCY.time():
+                response = api.get_presence(user_id)
             # in rare cases there is no last_active_ago sent
             if "last_active_ago" in response:
                 last_active_ago = response["last_active_ago"] // 1000
@@ -297,52 +1436,112 @@ def _update_user_activity_for_network(
                 last_active_ago = USER_PURGING_THRESHOLD + 1
             presence = response["presence"]
             last_seen = current_time - last_active_ago
-            user_activity[user_id] = last_seen
-            if user_activity[user_id] < deadline and presence == "offline":
+            store.set_last_seen(network_key, user_id, last_seen)
+            if last_seen < deadline and presence == "offline":
                 due_users.append(user_id)
 
         except MatrixError as ex:
+            errors += 1
+            METRIC_API_ERRORS.labels(endpoint="presence").inc()
             click.secho(f"Could not fetch user presence of {user_id}: {ex}")
         finally:
-            time.sleep(0.1)
+            remaining.dec()
+
+    # presence updates are only run for possible due users.
+    # This helps to spread the load on the server as good as possible
+    # Since this script runs once a day, every day a couple of users are
+    # going to be updated rather than all at once
+    started = time.monotonic()
+    pool = Pool(concurrency)
+    # joined explicitly, ``pool.join`` misses errors of greenlets which already finished
+    greenlets = [pool.spawn(fetch_presence, user_id) for user_id in possible_candidates]
+    gevent.joinall(greenlets, raise_error=True)
+    duration = time.monotonic() - started
+
+    if possible_candidates:
+        click.secho(
+            f"Fetched {len(possible_candidates)} presences in {duration:.1f}s "
+            f"({len(possible_candidates) / max(duration, 1e-6):.1f} req/s, {errors} errors)."
+        )
     return due_users
 
 
 def purge_inactive_users(
     api: GMatrixHttpApi,
-    global_user_activity: UserActivityInfo,
+    store: UserActivityStore,
     network_to_due_users: Dict[str, List[str]],
+    journal: PurgeJournal,
+    concurrency: int = DEFAULT_PURGE_CONCURRENCY,
+    max_purges: int = DEFAULT_MAX_PURGES_PER_RUN,
 ) -> None:
+    """
+    Adds the due users to the purge journal and deactivates up to ``max_purges`` users
+    from the journal, including users left over from previous runs.
+    """
+    now = int(time.time())
+    remaining = max_purges
     for network_key, due_users in network_to_due_users.items():
-        click.secho(f"Purging {len(due_users)} inactive users from Chain ID {network_key}")
+        journal.add_pending(network_key, due_users, now)
+        users_to_purge = journal.get_due(network_key, now, remaining)
+        remaining -= len(users_to_purge)
+        click.secho(f"Purging {len(users_to_purge)} inactive users from Chain ID {network_key}")
         _purge_inactive_users_for_network(
             api=api,
-            user_activity=global_user_activity["network_to_users"][network_key],
-            due_users=due_users,
+            store=store,
+            network_key=network_key,
+            due_users=users_to_purge,
+            journal=journal,
+            concurrency=concurrency,
         )
 
+    journal.prune(now - PURGE_JOURNAL_RETENTION)
+    for status in (PurgeJournal.PENDING, PurgeJournal.DONE, PurgeJournal.FAILED):
+        METRIC_JOURNAL_ENTRIES.labels(status=status).set(journal.count(status))
+    click.secho(
+        f"Purge journal: {journal.count(PurgeJournal.PENDING)} pending, "
+        f"{journal.count(PurgeJournal.FAILED)} failed."
+    )
+
 
 def _purge_inactive_users_for_network(
     api: GMatrixHttpApi,
-    user_activity: Dict[str, int],
+    store: UserActivityStore,
+    network_key: str,
     due_users: List[str],
+    journal: PurgeJournal,
+    concurrency: int = DEFAULT_PURGE_CONCURRENCY,
 ) -> None:
-    for user_id in due_users:
+    deadline = int(time.time()) - USER_PURGING_THRESHOLD
+
+    def deactivate(user_id: str) -> None:
+        last_seen = store.get_last_seen(network_key, user_id)
+        # users left over from a previous run may have left or come back since then
+        if last_seen is None or last_seen >= deadline:
+            journal.remove(network_key, user_id)
+            return
+
         try:
-            # delete user account and remove him from the user_activity_file
-            last_ago = (int(time.time()) - user_activity[user_id]) / (60 * 60 * 24)
+            # delete user account and remove him from the user activity store
+            last_ago = (int(time.time()) - last_seen) / (60 * 60 * 24)
             api._send(
                 "POST",
                 f"/deactivate/{user_id}",
                 content={"erase": True},
                 api_path="/_synapse/admin/v1",
             )
-            user_activity.pop(user_id, None)
+            store.remove_user(network_key, user_id)
+            journal.mark_done(network_key, user_id, int(time.time()))
+            METRIC_DEACTIVATIONS.labels(network=network_key, result="done").inc()
             click.secho(f"{user_id} deleted. Offline for {last_ago} days.")
         except MatrixError as ex:
+            journal.mark_failed(network_key, user_id, str(ex), int(time.time()))
+            METRIC_DEACTIVATIONS.labels(network=network_key, result="failed").inc()
+            METRIC_API_ERRORS.labels(endpoint="deactivate").inc()
             click.secho(f"Could not delete user {user_id} with error {ex}")
-        finally:
-            time.sleep(0.1)
+
+    pool = Pool(concurrency)
+    greenlets = [pool.spawn(deactivate, user_id) for user_id in due_users]
+    gevent.joinall(greenlets, raise_error=True)
 
 
 if __name__ == "__main__":
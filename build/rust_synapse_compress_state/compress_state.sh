@@ -3,63 +3,207 @@
 set -eo pipefail
 
 ## Global parameters
-REGULAR_SLEEP=$((3600 * 24 * 7))
+# How often to check whether compressing is worthwhile
+CHECK_INTERVAL=${COMPRESS_CHECK_INTERVAL:-$((3600 * 6))}
+# Compress at least this often, regardless of the growth
+MAX_INTERVAL=${COMPRESS_MAX_INTERVAL:-$((3600 * 24 * 7))}
+# Inserts into state_groups_state (as counted by pg_stat_user_tables) since the last
+# run which trigger a new run
+MIN_NEW_STATE_ROWS=${COMPRESS_MIN_NEW_STATE_ROWS:-1000000}
+# New state groups a room needs to have to be compressed
+MIN_NEW_STATE_GROUPS=${COMPRESS_MIN_NEW_STATE_GROUPS:-1000}
+# Number of rooms compressed at the same time
+PARALLELISM=${COMPRESS_PARALLELISM:-2}
+# Generated SQL files older than this are deleted
+KEEP_DAYS=${COMPRESS_KEEP_DAYS:-14}
+# Prometheus textfile, to be picked up by node_exporter's textfile collector
+METRICS_FILE=${COMPRESS_METRICS_FILE:-/data/metrics/compress_state.prom}
 
-# Check for last run (if any)
-LAST_FN="$(find /data -iname 'compress_state-*.sql'|rev|cut -d '_' -f1|rev|cut -d'.' -f1|head -1)"
+DB_URL="postgres://postgres@db/synapse"
+STATE_DIR=/data
+# room_id -> number of state groups at the last successful compression
+GROUPS_FILE="${STATE_DIR}/compress_state.groups"
+# room_id rows_saved duration_seconds timestamp success of the last compression
+RESULTS_FILE="${STATE_DIR}/compress_state.results"
+# timestamp and state_groups_state inserts of the last run
+LAST_RUN_FILE="${STATE_DIR}/compress_state.last_run"
 
-if [[ $LAST_FN ]];
-then
-    LAST_RUN_UTC=$(date --date="$LAST_FN" "+%s")
-    TIME_SINCE_LAST_RUN=$(echo "$(date '+%s') - $LAST_RUN_UTC" | bc)
-    EARLY_RESTART=$(echo "$TIME_SINCE_LAST_RUN < $REGULAR_SLEEP" | bc)
-fi
+psql_query() {
+    psql -U postgres -h db -w -d synapse -X -q -t -A -F ' ' -v ON_ERROR_STOP=1 "$@"
+}
 
-if [[ $EARLY_RESTART -gt 0 ]];
-then
-    # Sleep for the remainder of one week
-    INITIAL_SLEEP=$(echo "$REGULAR_SLEEP - $TIME_SINCE_LAST_RUN" | bc)
-else
-    # Select a random start time within the next ~7 days
-    INITIAL_SLEEP=$(echo "$(( RANDOM )) * 2.63 * 7" | bc)
-fi
+# Prints "room_id state_group_count" for all broadcast rooms and rooms in COMPRESS_ROOMS.
+# COMPRESS_ROOMS may contain room ids or local aliases.
+room_state_groups() {
+    psql_query -v extra_rooms="${COMPRESS_ROOMS}" <<'SQL'
+WITH extra AS (
+    SELECT unnest(string_to_array(trim(:'extra_rooms'), ' ')) AS room
+), rooms AS (
+    SELECT room_id FROM room_aliases WHERE room_alias LIKE '#raiden_%'
+    UNION
+    SELECT room_id FROM room_aliases JOIN extra ON room_alias = extra.room
+    UNION
+    SELECT room FROM extra WHERE room LIKE '!%'
+)
+SELECT sg.room_id, COUNT(*) FROM state_groups AS sg
+WHERE sg.room_id IN (SELECT room_id FROM rooms)
+GROUP BY sg.room_id;
+SQL
+}
 
-date
+state_rows_inserted() {
+    psql_query -c "SELECT n_tup_ins FROM pg_stat_user_tables WHERE relname = 'state_groups_state'"
+}
 
-echo "Sleeping for $INITIAL_SLEEP seconds"
-sleep "$INITIAL_SLEEP"
+# Decides whether enough state has been added since the last run
+is_run_due() {
+    local last_run=0 last_inserted=0 inserted
+    if [[ -f $LAST_RUN_FILE ]]; then
+        read -r last_run last_inserted < "$LAST_RUN_FILE"
+    fi
+    if (( $(date '+%s') - last_run >= MAX_INTERVAL )); then
+        return 0
+    fi
+    inserted=$(state_rows_inserted)
+    # the statistics counter is reset when postgres restarts
+    (( inserted < last_inserted || inserted - last_inserted >= MIN_NEW_STATE_ROWS ))
+}
 
-while true;
-do
-    date
-    COMPRESS_ROOMS="${COMPRESS_ROOMS}"
-    if [ -z "$COMPRESS_ROOMS" ];
-    then
-        echo "No rooms to work on, make sure you define 'COMPRESS_ROOMS' in environment"
-        exit 1
+# Prints "growth room_id state_group_count" for all rooms worth compressing, largest growth first
+rank_rooms() {
+    local room count growth
+    declare -A last_counts=()
+    if [[ -f $GROUPS_FILE ]]; then
+        while read -r room count; do
+            last_counts[$room]=$count
+        done < "$GROUPS_FILE"
     fi
-    # loop through rooms
-    for ROOM in $(printf "%s" "$COMPRESS_ROOMS");
-    do
-        # Construct a filename
-        FN="/data/compress_state-${ROOM}_$(date -Iseconds).sql"
 
-        date
-        echo "Compressing state for $ROOM"
+    room_state_groups | while read -r room count; do
+        [[ $room ]] || continue
+        growth=$(( count - ${last_counts[$room]:-0} ))
+        if (( growth >= MIN_NEW_STATE_GROUPS )); then
+            echo "$growth $room $count"
+        fi
+    done | sort -rn
+}
 
-        synapse-compress-state -p "postgres://postgres@db/synapse" -r "$ROOM" -o "$FN" -t
+# Compresses one room and writes "room_id rows_saved duration timestamp success" to $2
+compress_room() {
+    local room="$1" result_file="$2" fn log started rows_before rows_after success=0
+    fn="${STATE_DIR}/compress_state-${room}_$(date -Iseconds).sql"
+    log="${fn%.sql}.log"
+    started=$(date '+%s')
 
-        date
-        echo "Applying changes for $ROOM"
+    echo "Compressing state for $room"
+    if synapse_compress_state -p "$DB_URL" -r "$room" -o "$fn" > "$log" 2>&1; then
+        echo "Applying changes for $room"
+        if psql_query --single-transaction -f "$fn"; then
+            success=1
+        fi
+    fi
+    cat "$log"
+
+    # the lines may be prefixed by the log level and target
+    rows_before=$(sed -n 's/.*Number of rows in current table: \([0-9]*\).*/\1/p' "$log")
+    rows_after=$(sed -n 's/.*Number of rows after compression: \([0-9]*\).*/\1/p' "$log")
+    rm -f "$log"
+    if (( ! success )); then
+        rows_after=$rows_before
+    fi
+    echo "$room $(( ${rows_before:-0} - ${rows_after:-0} )) $(( $(date '+%s') - started )) $(date '+%s') $success" > "$result_file"
+    echo "Done with $room, success=$success"
+}
 
-        # now remotely run psql to apply
-        psql -U postgres -h db -w -d synapse -f "$FN"
+write_metrics() {
+    local tmp room rows_saved duration timestamp success
+    [[ -f $RESULTS_FILE ]] || return 0
+    mkdir -p "$(dirname "$METRICS_FILE")"
+    tmp="${METRICS_FILE}.$$"
+    {
+        echo "# HELP synapse_compress_state_rows_saved Rows removed by the last state compression of a room"
+        echo "# TYPE synapse_compress_state_rows_saved gauge"
+        while read -r room rows_saved duration timestamp success; do
+            echo "synapse_compress_state_rows_saved{room_id=\"$room\"} $rows_saved"
+        done < "$RESULTS_FILE"
+        echo "# HELP synapse_compress_state_duration_seconds Duration of the last state compression of a room"
+        echo "# TYPE synapse_compress_state_duration_seconds gauge"
+        while read -r room rows_saved duration timestamp success; do
+            echo "synapse_compress_state_duration_seconds{room_id=\"$room\"} $duration"
+        done < "$RESULTS_FILE"
+        echo "# HELP synapse_compress_state_timestamp_seconds Time of the last state compression of a room"
+        echo "# TYPE synapse_compress_state_timestamp_seconds gauge"
+        while read -r room rows_saved duration timestamp success; do
+            echo "synapse_compress_state_timestamp_seconds{room_id=\"$room\"} $timestamp"
+        done < "$RESULTS_FILE"
+        echo "# HELP synapse_compress_state_success Whether the last state compression of a room succeeded"
+        echo "# TYPE synapse_compress_state_success gauge"
+        while read -r room rows_saved duration timestamp success; do
+            echo "synapse_compress_state_success{room_id=\"$room\"} $success"
+        done < "$RESULTS_FILE"
+    } > "$tmp"
+    mv "$tmp" "$METRICS_FILE"
+}
 
-        date
-        echo "Done"
+# Merges the results of a run into the state files
+record_results() {
+    local run_dir="$1" result room rows_saved duration timestamp success count
+    declare -A counts=()
+    while read -r _ room count; do
+        counts[$room]=$count
+    done < "${run_dir}/ranking"
+
+    for result in "${run_dir}"/*.result; do
+        [[ -f $result ]] || continue
+        read -r room rows_saved duration timestamp success < "$result"
+        touch "$RESULTS_FILE" "$GROUPS_FILE"
+        { grep -v "^${room} " "$RESULTS_FILE" || true; cat "$result"; } > "${RESULTS_FILE}.tmp"
+        mv "${RESULTS_FILE}.tmp" "$RESULTS_FILE"
+        # only successfully compressed rooms start over counting their growth
+        if (( success )); then
+            { grep -v "^${room} " "$GROUPS_FILE" || true; echo "$room ${counts[$room]}"; } > "${GROUPS_FILE}.tmp"
+            mv "${GROUPS_FILE}.tmp" "$GROUPS_FILE"
+        fi
     done
+}
+
+run() {
+    local run_dir room index=0
+    run_dir=$(mktemp -d)
+
+    rank_rooms > "${run_dir}/ranking"
+    if [[ ! -s ${run_dir}/ranking ]]; then
+        echo "No rooms with at least $MIN_NEW_STATE_GROUPS new state groups"
+    fi
+
+    # compress the rooms with the largest growth first, at most $PARALLELISM at a time
+    while read -r _ room _; do
+        while (( $(jobs -rp | wc -l) >= PARALLELISM )); do
+            wait -n || true
+        done
+        compress_room "$room" "${run_dir}/${index}.result" &
+        index=$(( index + 1 ))
+    done < "${run_dir}/ranking"
+    wait
+
+    record_results "$run_dir"
+    rm -rf "$run_dir"
+    echo "$(date '+%s') $(state_rows_inserted)" > "$LAST_RUN_FILE"
+    write_metrics
+
+    # prune generated SQL files of previous runs
+    find "$STATE_DIR" -maxdepth 1 -name 'compress_state-*.sql' -mtime +"$KEEP_DAYS" -print -delete
+}
+
+while true;
+do
+    date
+    if is_run_due; then
+        run
+    else
+        echo "Not enough new state since the last run"
+    fi
 
-    # Now sleep until next execution
-    echo "Sleeping for $REGULAR_SLEEP seconds"
-    sleep $REGULAR_SLEEP
+    echo "Sleeping for $CHECK_INTERVAL seconds"
+    sleep "$CHECK_INTERVAL"
 done
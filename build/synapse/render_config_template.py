@@ -1,7 +1,10 @@
+import fcntl
+import hashlib
 import json
 import os
 import random
 import string
+import time
 from json.decoder import JSONDecodeError
 from pathlib import Path
 from typing import Optional
@@ -12,8 +15,6 @@ import click
 from eth_typing import ChecksumAddress
 from eth_utils import to_checksum_address
 
-from docker import Client
-
 PATH_CONFIG_SYNAPSE = Path("/config/synapse.yaml")
 PATH_CONFIG_TEMPLATE_SYNAPSE = Path("/config/synapse.template.yaml")
 PATH_CONFIG_WORKER_BASE = Path("/config/workers/")
@@ -22,11 +23,25 @@ PATH_CONFIG_TEMPLATE_WORKER = PATH_CONFIG_WORKER_BASE.joinpath("worker.template.
 PATH_MACAROON_KEY = Path("/data/keys/macaroon.key")
 PATH_ADMIN_USER_CREDENTIALS = Path("/config/admin_user_cred.json")
 PATH_KNOWN_FEDERATION_SERVERS = Path("/data/known_federation_servers.json")
+PATH_CONFIG_SYNAPSE_INPUTS_HASH = Path("/data/synapse_config.inputs.sha256")
+# Hash of the federation whitelist in the rendered config, compared by the purger
+PATH_CONFIG_SYNAPSE_WHITELIST_HASH = Path("/data/synapse_config.whitelist.sha256")
 PATH_WELL_KNOWN_FILE = Path("/data_well_known/server")
+PATH_WORKER_LEASES = Path("/data/worker_leases/")
 
 # This file gets created during docker build from the given Raiden version
 PATH_KNOWN_FEDERATION_SERVERS_DEFAULT_URL = Path("/known_servers.default.txt")
 
+# Seconds to wait for the known servers list. If a cached list exists, startup
+# shouldn't be held up by a slow or unreachable server for long.
+KNOWN_SERVERS_TIMEOUT_CACHED = float(os.environ.get("KNOWN_SERVERS_FETCH_TIMEOUT", 5))
+KNOWN_SERVERS_TIMEOUT_UNCACHED = 60.0
+
+# Seconds after which the worker index of a stopped worker can be taken over. Running
+# workers renew their lease more often, see synapse-entrypoint.sh.
+WORKER_LEASE_TIMEOUT = 60
+WORKER_LEASE_RETRY_INTERVAL = 5
+
 
 def get_macaroon_key() -> str:
     if not PATH_MACAROON_KEY.exists():
@@ -42,9 +57,13 @@ def get_known_federation_servers(url_known_federation_servers: Optional[str]) ->
     if not url_known_federation_servers:
         # Env variable not set or empty, use default
         url_known_federation_servers = PATH_KNOWN_FEDERATION_SERVERS_DEFAULT_URL.read_text()
+    if PATH_KNOWN_FEDERATION_SERVERS.exists():
+        timeout = KNOWN_SERVERS_TIMEOUT_CACHED
+    else:
+        timeout = KNOWN_SERVERS_TIMEOUT_UNCACHED
     print("Fetching known federation servers from:", url_known_federation_servers)
     try:
-        resp = urlopen(url_known_federation_servers)
+        resp = urlopen(url_known_federation_servers, timeout=timeout)
         if 200 <= resp.code < 300:
             try:
                 known_servers = json.loads(resp.read().decode())
@@ -55,28 +74,60 @@ def get_known_federation_servers(url_known_federation_servers: Optional[str]) ->
                 print("Error loading known servers list:", resp.code, resp.read().decode())
         else:
             print("Error fetching known servers list:", resp.code, resp.read().decode())
-    except URLError as ex:
-        print("Error fetching known servers list", ex)
+    except (URLError, OSError) as ex:
+        # ``OSError`` covers timeouts while reading the response
+        print("Error fetching known servers list, using cached one if available:", ex)
     if PATH_KNOWN_FEDERATION_SERVERS.exists():
         return PATH_KNOWN_FEDERATION_SERVERS.read_text()
     return ""
 
 
+def whitelist_hash(known_servers: str) -> str:
+    # Has to match ``whitelist_hash`` in build/purger/purger.py
+    servers = [line[len("- ") :] for line in known_servers.splitlines() if line.startswith("- ")]
+    return hashlib.sha256(json.dumps(servers).encode()).hexdigest()
+
+
 def render_synapse_config(
     server_name: str,
     service_registry_address: ChecksumAddress,
     eth_rpc_url: str,
     url_known_federation_servers: Optional[str],
+    federation_sender_count: int = 0,
+    user_dir_worker_count: int = 0,
 ) -> None:
     template_content = PATH_CONFIG_TEMPLATE_SYNAPSE.read_text()
-    rendered_config = string.Template(template_content).substitute(
+    # Names have to match the ones given to the workers in `render_worker_config`
+    federation_sender_instances = [
+        f"federation_sender_{index}" for index in range(federation_sender_count)
+    ]
+    substitutions = dict(
         MACAROON_KEY=get_macaroon_key(),
         SERVER_NAME=server_name,
         KNOWN_SERVERS=get_known_federation_servers(url_known_federation_servers),
         ETH_RPC=eth_rpc_url,
         SERVICE_REGISTRY=service_registry_address,
+        SEND_FEDERATION=json.dumps(not federation_sender_instances),
+        FEDERATION_SENDER_INSTANCES=json.dumps(federation_sender_instances),
+        UPDATE_USER_DIRECTORY=json.dumps(user_dir_worker_count == 0),
     )
+
+    # Skip rendering if neither the template nor any of the values changed
+    inputs_hash = hashlib.sha256(
+        json.dumps([template_content, substitutions], sort_keys=True).encode()
+    ).hexdigest()
+    PATH_CONFIG_SYNAPSE_WHITELIST_HASH.write_text(whitelist_hash(substitutions["KNOWN_SERVERS"]))
+    if (
+        PATH_CONFIG_SYNAPSE.exists()
+        and PATH_CONFIG_SYNAPSE_INPUTS_HASH.exists()
+        and PATH_CONFIG_SYNAPSE_INPUTS_HASH.read_text() == inputs_hash
+    ):
+        print("Synapse config is up to date")
+        return
+
+    rendered_config = string.Template(template_content).substitute(substitutions)
     PATH_CONFIG_SYNAPSE.write_text(rendered_config)
+    PATH_CONFIG_SYNAPSE_INPUTS_HASH.write_text(inputs_hash)
 
 
 def render_well_known_file(server_name: str) -> None:
@@ -99,23 +150,49 @@ def generate_admin_user_credentials() -> None:
     )
 
 
-def render_worker_config(type_: str) -> Path:
-    # Fetch compose scale index
-    client = Client.from_env()
-    own_container_labels = next(
-        container["Labels"]
-        for container in client.containers()
-        if container["Id"].startswith(os.environ["HOSTNAME"])
-    )
-    own_container_index = (
-        int(own_container_labels.get("com.docker.compose.container-number"), 0) - 1
-    )
+def claim_worker_index(type_: str, worker_count: int) -> int:
+    """
+    Claims the lowest index of the given worker type which isn't used by another worker.
+
+    The docker API isn't used to look up the compose scale index, since the workers serve
+    public traffic and must not have access to the docker daemon. Instead, every worker
+    holds a lease file named after its index. A restarted container keeps its index. The
+    entrypoint removes the lease when the worker stops, the lease of a killed container
+    can be taken over once it expired.
+    """
+    PATH_WORKER_LEASES.mkdir(parents=True, exist_ok=True)
+    hostname = os.environ["HOSTNAME"]
+    while True:
+        with PATH_WORKER_LEASES.joinpath(".lock").open("w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            free_index = None
+            for index in range(worker_count):
+                lease = PATH_WORKER_LEASES.joinpath(f"{type_}_{index}")
+                if lease.exists() and lease.read_text() == hostname:
+                    free_index = index
+                    break
+                expired = (
+                    not lease.exists()
+                    or time.time() - lease.stat().st_mtime > WORKER_LEASE_TIMEOUT
+                )
+                if expired and free_index is None:
+                    free_index = index
+            if free_index is not None:
+                PATH_WORKER_LEASES.joinpath(f"{type_}_{free_index}").write_text(hostname)
+                return free_index
+        # stdout is used to return the config path
+        click.echo(f"All {worker_count} {type_} indices are taken, waiting", err=True)
+        time.sleep(WORKER_LEASE_RETRY_INTERVAL)
+
+
+def render_worker_config(type_: str, worker_count: int) -> Path:
+    worker_index = claim_worker_index(type_, worker_count)
 
     template_content = PATH_CONFIG_TEMPLATE_WORKER.read_text()
     rendered_content = string.Template(template_content).substitute(
-        WORKER_APP=type_, WORKER_INDEX=own_container_index
+        WORKER_APP=type_, WORKER_INDEX=worker_index
     )
-    target_file = PATH_CONFIG_WORKER_BASE.joinpath(f"{type_}_{own_container_index}.yaml")
+    target_file = PATH_CONFIG_WORKER_BASE.joinpath(f"{type_}_{worker_index}.yaml")
     target_file.write_text(rendered_content)
     return target_file
 
@@ -131,12 +208,19 @@ def synapse() -> None:
     server_name = os.environ["SERVER_NAME"]
     eth_rpc_url = os.environ["ETH_RPC"]
     service_registry_address = to_checksum_address(os.environ["SERVICE_REGISTRY"])
+    # The main process hands work over to these workers, if they are started
+    federation_sender_count = int(os.environ.get("FEDERATION_SENDER_COUNT") or 0)
+    user_dir_worker_count = int(os.environ.get("USER_DIR_WORKER_COUNT") or 0)
+    if user_dir_worker_count > 1:
+        raise click.BadParameter("Synapse supports only a single user_dir worker")
 
     render_synapse_config(
         server_name=server_name,
         service_registry_address=service_registry_address,
         eth_rpc_url=eth_rpc_url,
         url_known_federation_servers=url_known_federation_servers,
+        federation_sender_count=federation_sender_count,
+        user_dir_worker_count=user_dir_worker_count,
     )
     render_well_known_file(server_name=server_name)
     generate_admin_user_credentials()
@@ -144,10 +228,15 @@ def synapse() -> None:
 
 @main.command()
 @click.option(
-    "--type", "type_", type=click.Choice(["generic_worker", "federation_sender", "user_dir"])
+    "--type",
+    "type_",
+    type=click.Choice(["generic_worker", "federation_sender", "user_dir"]),
+    required=True,
 )
-def worker(type_) -> None:
-    target_file = render_worker_config(type_)
+def worker(type_: str) -> None:
+    # The scale of the compose service, worker indices are taken from range(WORKER_SCALE)
+    worker_count = int(os.environ.get("WORKER_SCALE") or 1)
+    target_file = render_worker_config(type_, worker_count)
     print(str(target_file))
 
 
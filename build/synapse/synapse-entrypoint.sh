@@ -9,19 +9,54 @@ mkdir -p /data/keys
 TYPE="$1"
 shift
 
+# Remember the whitelist this container is started with, the purger restarts it once
+# the whitelist changes
+store_whitelist_hash() {
+  cp /data/synapse_config.whitelist.sha256 /run/synapse_whitelist.sha256
+}
+
 if [[ $TYPE == 'worker' ]]; then
-  echo "WORKERS ARE DISABLED!"
-  exit 1
   WORKER="$1"
   shift
   CONFIG_PATH=$(/synapse-venv/bin/python /bin/render_config_template.py "$TYPE" --type "$WORKER")
+  # Workers load the config rendered by the main process
+  store_whitelist_hash
+
+  # Renew the lease of the worker index while the worker is running, it expires after
+  # WORKER_LEASE_TIMEOUT (see render_config_template.py) if the container is killed
+  LEASE_PATH="/data/worker_leases/$(basename "$CONFIG_PATH" .yaml)"
+  ( while sleep 15; do touch "$LEASE_PATH"; done ) &
+  RENEW_PID=$!
+
+  # Not exec'ed, the lease is released once the worker stopped, so a recreated container
+  # can take over the index right away
+  /synapse-venv/bin/python -m "synapse.app.${WORKER}" --config-path /config/synapse.yaml --config-path "${CONFIG_PATH}" &
+  WORKER_PID=$!
+  trap 'kill -TERM "$WORKER_PID" 2>/dev/null' TERM INT
+
+  set +e
+  wait "$WORKER_PID"
+  EXIT_CODE=$?
+  # a trapped signal interrupts wait, wait until the worker has shut down
+  while kill -0 "$WORKER_PID" 2>/dev/null; do
+    wait "$WORKER_PID"
+    EXIT_CODE=$?
+  done
 
-  /synapse-venv/bin/python -m "synapse.app.${WORKER}" --config-path /config/synapse.yaml --config-path "${CONFIG_PATH}"
+  kill "$RENEW_PID"
+  if [[ $(cat "$LEASE_PATH" 2>/dev/null) == "$HOSTNAME" ]]; then
+    rm -f "$LEASE_PATH"
+  fi
+  exit $EXIT_CODE
 elif [[ $TYPE == 'synapse' ]]; then
   /synapse-venv/bin/python /bin/render_config_template.py "$TYPE"
-  /synapse-venv/bin/python -m synapse.app.homeserver --config-path /config/synapse.yaml --generate-keys
+  store_whitelist_hash
+  # Generating keys needs a full synapse start, only do it if there is no signing key yet
+  if [[ ! -s /data/keys/synapse-signing.key ]]; then
+    /synapse-venv/bin/python -m synapse.app.homeserver --config-path /config/synapse.yaml --generate-keys
+  fi
 
-  /synapse-venv/bin/python -m synapse.app.homeserver --config-path /config/synapse.yaml
+  exec /synapse-venv/bin/python -m synapse.app.homeserver --config-path /config/synapse.yaml
 else
   echo "Unknown run type: $TYPE"
   exit 1
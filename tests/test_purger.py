@@ -1,13 +1,44 @@
 import json
+import os
+import sqlite3
 import string
 import time
 from random import randint
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 import pytest
-from build.purger.purger import USER_PURGING_THRESHOLD, run_user_purger
+import requests
+from click.testing import CliRunner
+from build.purger.purger import (
+    CURRENT_STATE_DELTA_POSITION_QUERY,
+    MEMBER_SYNC_INCREMENTAL,
+    MEMBERSHIP_DELTA_QUERY,
+    METRICS_REGISTRY,
+    PURGE_RETRY_BACKOFF,
+    USER_ACTIVITY_QUERY,
+    USER_PURGING_THRESHOLD,
+    InMemoryUserActivityStore,
+    PurgeJournal,
+    SqlitePurgeJournal,
+    SqliteUserActivityStore,
+    TokenBucket,
+    fetch_federation_whitelist,
+    load_whitelist_cache,
+    migrate_user_activity_file,
+    purge,
+    purge_inactive_users,
+    restart_outdated_containers,
+    run_user_purger,
+    whitelist_hash,
+)
 from tests.file_templates import USER_PRESENCE_TEMPLATE
-from tests.utils import GMatrixHttpApiTest, create_user_activity_dict
+from tests.utils import (
+    FakeContainer,
+    FakeDatabaseConnection,
+    FakeDockerClient,
+    GMatrixHttpApiTest,
+    create_user_activity_dict,
+)
 
 from raiden.constants import Networks
 
@@ -69,15 +100,66 @@ def mocked_matrix_api(
     )
 
 
+# Minimal versions of the synapse tables read by the purger
+SYNAPSE_TEST_SCHEMA = """
+CREATE TEMPORARY TABLE users (name TEXT, deactivated SMALLINT DEFAULT 0 NOT NULL);
+CREATE TEMPORARY TABLE local_current_membership (
+    room_id TEXT, user_id TEXT, event_id TEXT, membership TEXT
+);
+CREATE TEMPORARY TABLE presence_stream (
+    stream_id BIGINT, event_id TEXT, user_id TEXT, state TEXT, last_active_ts BIGINT,
+    last_federation_update_ts BIGINT, last_user_sync_ts BIGINT, status_msg TEXT,
+    currently_active BOOLEAN
+);
+CREATE TEMPORARY TABLE user_ips (
+    user_id TEXT, access_token TEXT, device_id TEXT, ip TEXT, user_agent TEXT, last_seen BIGINT
+);
+CREATE TEMPORARY TABLE current_state_delta_stream (
+    stream_id BIGINT, room_id TEXT, type TEXT, state_key TEXT, event_id TEXT,
+    prev_event_id TEXT, instance_name TEXT
+);
+CREATE TEMPORARY TABLE room_memberships (
+    event_id TEXT, user_id TEXT, sender TEXT, room_id TEXT, membership TEXT
+);
+"""
+
+
+@pytest.fixture
+def synapse_db_cursor():
+    """Cursor of a postgres database with the synapse tables, given by PURGER_TEST_DB_DSN"""
+    psycopg2 = pytest.importorskip("psycopg2")
+    connection = psycopg2.connect(os.environ["PURGER_TEST_DB_DSN"])
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(SYNAPSE_TEST_SCHEMA)
+            yield cursor
+    finally:
+        connection.rollback()
+        connection.close()
+
+
 @pytest.mark.parametrize("last_update_in_days", [3])
 @pytest.mark.parametrize("due_users_count, active_users_count", [(5, 10)])
 @pytest.mark.parametrize("activity_changed_count", [2])
 @pytest.mark.parametrize("networks", [[Networks.GOERLI]])
+@pytest.mark.parametrize("presence_concurrency", [1, 4])
 def test_due_users_get_kicked(
-    mocked_matrix_api, global_user_activity, active_users_count, activity_changed_count, networks
+    mocked_matrix_api,
+    global_user_activity,
+    active_users_count,
+    activity_changed_count,
+    networks,
+    presence_concurrency,
 ):
 
-    new_global_user_activity = run_user_purger(mocked_matrix_api, global_user_activity)
+    store = InMemoryUserActivityStore(global_user_activity)
+    run_user_purger(
+        mocked_matrix_api,
+        store,
+        presence_concurrency=presence_concurrency,
+        presence_rate=1000,
+    )
+    new_global_user_activity = store.user_activity_info
     # assert that number of user reduced as expected
     assert (
         len(new_global_user_activity["network_to_users"][str(networks[0].value)])
@@ -93,3 +175,461 @@ def test_due_users_get_kicked(
     ]
     # assert that there are no due users in the dictionary anymore
     assert len(due_user_items) == 0
+
+
+@pytest.mark.parametrize("last_update_in_days", [3])
+@pytest.mark.parametrize("due_users_count, active_users_count", [(5, 0)])
+@pytest.mark.parametrize("activity_changed_count", [0])
+@pytest.mark.parametrize("networks", [[Networks.GOERLI]])
+def test_unexpected_presence_error_propagates(mocked_matrix_api, global_user_activity):
+    # only matrix errors are handled, anything else has to abort the run. The first request
+    # fails, its greenlet has left the pool long before all others are spawned.
+    get_presence = mocked_matrix_api.get_presence
+    calls = []
+
+    def get_presence_without_presence_key(user_id):
+        calls.append(user_id)
+        return {"last_active_ago": 0} if len(calls) == 1 else get_presence(user_id)
+
+    mocked_matrix_api.get_presence = get_presence_without_presence_key
+
+    with pytest.raises(KeyError):
+        run_user_purger(
+            mocked_matrix_api,
+            InMemoryUserActivityStore(global_user_activity),
+            presence_concurrency=2,
+            presence_rate=1000,
+        )
+
+
+def test_token_bucket_limits_rate():
+    rate_limiter = TokenBucket(rate=50, capacity=1)
+
+    started = time.monotonic()
+    for _ in range(11):
+        rate_limiter.acquire()
+
+    # the first token is available immediately, the other ten need to be refilled
+    assert time.monotonic() - started >= 10 / 50 * 0.9
+
+
+@pytest.mark.parametrize("last_update_in_days", [3])
+@pytest.mark.parametrize("due_users_count, active_users_count", [(5, 10)])
+@pytest.mark.parametrize("activity_changed_count", [0])
+@pytest.mark.parametrize("networks", [[Networks.GOERLI]])
+def test_user_activity_from_database(
+    mocked_matrix_api, global_user_activity, due_users, active_users, networks
+):
+    current_time = int(time.time())
+    # the database knows about all due users and reports one of them as active again
+    due_user_ids = list(due_users.keys())
+    rows = [(user_id, due_users[user_id] * 1000, "offline") for user_id in due_user_ids[1:]]
+    rows.append((due_user_ids[0], current_time * 1000, "online"))
+    db_connection = FakeDatabaseConnection(rows)
+
+    store = InMemoryUserActivityStore(global_user_activity)
+    run_user_purger(mocked_matrix_api, store, db_connection=db_connection)
+    new_global_user_activity = store.user_activity_info
+
+    user_activity = new_global_user_activity["network_to_users"][str(networks[0].value)]
+    assert [query for query, _ in db_connection.executed].count(USER_ACTIVITY_QUERY) == 1
+    assert set(user_activity.keys()) == {due_user_ids[0], *active_users.keys()}
+    assert user_activity[due_user_ids[0]] == current_time
+
+
+@pytest.mark.skipif(
+    not os.environ.get("PURGER_TEST_DB_DSN"), reason="PURGER_TEST_DB_DSN is not set"
+)
+def test_user_activity_query(synapse_db_cursor):
+    room_id = "!discovery:ownserver.com"
+    synapse_db_cursor.executemany(
+        "INSERT INTO users (name, deactivated) VALUES (%s, %s)",
+        [
+            ("@0x1:ownserver.com", 0),
+            ("@0x2:ownserver.com", 0),
+            ("@0x3:ownserver.com", 0),
+            ("@0x4:ownserver.com", 1),
+            ("@0x5:ownserver.com", 0),
+            ("@admin-ownserver.com:ownserver.com", 0),
+        ],
+    )
+    synapse_db_cursor.executemany(
+        "INSERT INTO local_current_membership (room_id, user_id, membership) VALUES (%s, %s, %s)",
+        [
+            (room_id, "@0x1:ownserver.com", "join"),
+            (room_id, "@0x2:ownserver.com", "join"),
+            (room_id, "@0x3:ownserver.com", "join"),
+            (room_id, "@0x4:ownserver.com", "join"),
+            (room_id, "@0x5:ownserver.com", "leave"),
+            ("!other:ownserver.com", "@0x5:ownserver.com", "join"),
+            (room_id, "@admin-ownserver.com:ownserver.com", "join"),
+        ],
+    )
+    synapse_db_cursor.executemany(
+        "INSERT INTO presence_stream (user_id, state, last_active_ts, last_user_sync_ts) "
+        "VALUES (%s, %s, %s, %s)",
+        [("@0x1:ownserver.com", "online", 1000, 1500), ("@0x3:ownserver.com", None, 2000, 500)],
+    )
+    synapse_db_cursor.executemany(
+        "INSERT INTO user_ips (user_id, last_seen) VALUES (%s, %s)",
+        [("@0x1:ownserver.com", 3000), ("@0x1:ownserver.com", 2500)],
+    )
+
+    synapse_db_cursor.execute(USER_ACTIVITY_QUERY, {"room_id": room_id})
+
+    # users without presence or client ips have no activity and count as offline
+    assert sorted(synapse_db_cursor.fetchall()) == [
+        ("@0x1:ownserver.com", 3000, "online"),
+        ("@0x2:ownserver.com", None, "offline"),
+        ("@0x3:ownserver.com", 2000, "offline"),
+    ]
+
+
+@pytest.mark.skipif(
+    not os.environ.get("PURGER_TEST_DB_DSN"), reason="PURGER_TEST_DB_DSN is not set"
+)
+def test_membership_delta_query(synapse_db_cursor):
+    room_id = "!discovery:ownserver.com"
+    synapse_db_cursor.executemany(
+        "INSERT INTO current_state_delta_stream (stream_id, room_id, type, state_key, event_id) "
+        "VALUES (%s, %s, %s, %s, %s)",
+        [
+            (1, room_id, "m.room.member", "@0x1:ownserver.com", "$join1"),
+            (2, room_id, "m.room.member", "@0x2:ownserver.com", "$join2"),
+            (3, room_id, "m.room.name", "", "$name"),
+            (4, "!other:ownserver.com", "m.room.member", "@0x3:ownserver.com", "$join3"),
+            (5, room_id, "m.room.member", "@0x1:ownserver.com", "$ban1"),
+            (6, room_id, "m.room.member", "@0x2:ownserver.com", None),
+        ],
+    )
+    synapse_db_cursor.executemany(
+        "INSERT INTO room_memberships (event_id, user_id, room_id, membership) "
+        "VALUES (%s, %s, %s, %s)",
+        [
+            ("$join1", "@0x1:ownserver.com", room_id, "join"),
+            ("$join2", "@0x2:ownserver.com", room_id, "join"),
+            ("$join3", "@0x3:ownserver.com", "!other:ownserver.com", "join"),
+            ("$ban1", "@0x1:ownserver.com", room_id, "ban"),
+        ],
+    )
+
+    synapse_db_cursor.execute(MEMBERSHIP_DELTA_QUERY, {"room_id": room_id, "stream_id": 1})
+    # a removed membership state has no event and counts as leave
+    assert synapse_db_cursor.fetchall() == [
+        (2, "@0x2:ownserver.com", "join"),
+        (5, "@0x1:ownserver.com", "ban"),
+        (6, "@0x2:ownserver.com", "leave"),
+    ]
+    synapse_db_cursor.execute(CURRENT_STATE_DELTA_POSITION_QUERY)
+    assert synapse_db_cursor.fetchone() == (6,)
+
+
+def test_sqlite_user_activity_store(tmp_path):
+    network_key = str(Networks.GOERLI.value)
+    store = SqliteUserActivityStore(str(tmp_path / "user_activity.db"), commit_batch_size=2)
+    store.add_network(network_key)
+    store.add_users(network_key, ["@a:server", "@b:server", "@c:server"], 100)
+    store.set_last_seen(network_key, "@b:server", 300)
+    # known users are not overwritten when they are added again
+    store.add_users(network_key, ["@b:server", "@d:server"], 100)
+    store.remove_user(network_key, "@c:server")
+
+    assert store.networks() == [network_key]
+    assert store.count_users(network_key) == 3
+    assert sorted(store.get_overdue_users(network_key, 200)) == ["@a:server", "@d:server"]
+    assert store.get_last_seen(network_key, "@b:server") == 300
+    store.close()
+
+    # all changes are persisted
+    store = SqliteUserActivityStore(str(tmp_path / "user_activity.db"))
+    assert store.count_users() == 3
+    store.close()
+
+
+@pytest.mark.parametrize("last_update_in_days", [3])
+@pytest.mark.parametrize("due_users_count, active_users_count", [(5, 10)])
+@pytest.mark.parametrize("networks", [[Networks.GOERLI, Networks.MAINNET]])
+def test_migrate_user_activity_file(tmp_path, global_user_activity, networks):
+    json_path = tmp_path / "user_activity.json"
+    json_path.write_text(json.dumps(global_user_activity))
+    store = SqliteUserActivityStore(str(tmp_path / "user_activity.db"))
+
+    migrate_user_activity_file(store, json_path)
+
+    assert not json_path.exists()
+    assert store.get_last_update() == global_user_activity["last_update"]
+    assert sorted(store.networks()) == sorted(str(network.value) for network in networks)
+    for network_key, user_activity in global_user_activity["network_to_users"].items():
+        assert store.count_users(network_key) == len(user_activity)
+        for user_id, last_seen in user_activity.items():
+            assert store.get_last_seen(network_key, user_id) == last_seen
+
+
+@pytest.mark.parametrize("last_update_in_days", [3])
+@pytest.mark.parametrize("due_users_count, active_users_count", [(0, 5)])
+@pytest.mark.parametrize("activity_changed_count", [0])
+@pytest.mark.parametrize("networks", [[Networks.GOERLI]])
+def test_incremental_member_sync(mocked_matrix_api, global_user_activity, active_users, networks):
+    network_key = str(networks[0].value)
+    store = InMemoryUserActivityStore(global_user_activity)
+    # the store must not share its users with the presences known to the mocked api
+    mocked_matrix_api.user_presence = dict(mocked_matrix_api.user_presence)
+    left_user = "@0x0000000000000000000000000000000000000001:ownserver.com"
+    inactive_user = "@0x0000000000000000000000000000000000000002:ownserver.com"
+    online_user = "@0x0000000000000000000000000000000000000003:ownserver.com"
+    unknown_user = "@0x0000000000000000000000000000000000000004:ownserver.com"
+    store.set_last_seen(network_key, left_user, int(time.time()))
+    mocked_matrix_api.user_presence[inactive_user] = USER_PURGING_THRESHOLD + 1
+    mocked_matrix_api.activity_change[online_user] = 0
+
+    # the first sync stores a position, following syncs only process changes since then
+    run_user_purger(mocked_matrix_api, store, member_sync=MEMBER_SYNC_INCREMENTAL)
+    assert list(store.metadata.values()) == ["end"]
+    store.metadata = {key: "start" for key in store.metadata}
+
+    mocked_matrix_api.member_events = [
+        {"state_key": left_user, "content": {"membership": "leave"}},
+        {"state_key": inactive_user, "content": {"membership": "join"}},
+        {"state_key": online_user, "content": {"membership": "join"}},
+        {"state_key": unknown_user, "content": {"membership": "join"}},
+        {"state_key": "@admin-ownserver.com:ownserver.com", "content": {"membership": "join"}},
+        {"state_key": "@0x05:otherserver.com", "content": {"membership": "join"}},
+    ]
+    store.set_last_update(0)
+    run_user_purger(mocked_matrix_api, store, member_sync=MEMBER_SYNC_INCREMENTAL)
+
+    user_activity = store.user_activity_info["network_to_users"][network_key]
+    assert left_user not in user_activity
+    # new members are added as overdue, only those offline for too long are purged
+    assert inactive_user not in user_activity
+    assert online_user in user_activity
+    # users whose presence can not be fetched are kept
+    assert unknown_user in user_activity
+    assert set(user_activity.keys()) == {*active_users.keys(), online_user, unknown_user}
+    assert list(store.metadata.values()) == ["end"]
+
+
+@pytest.mark.parametrize("last_update_in_days", [3])
+@pytest.mark.parametrize("due_users_count, active_users_count", [(0, 5)])
+@pytest.mark.parametrize("activity_changed_count", [0])
+@pytest.mark.parametrize("networks", [[Networks.GOERLI]])
+def test_incremental_member_sync_from_database(
+    mocked_matrix_api, global_user_activity, active_users, networks
+):
+    network_key = str(networks[0].value)
+    store = InMemoryUserActivityStore(global_user_activity)
+    mocked_matrix_api.user_presence = dict(mocked_matrix_api.user_presence)
+    left_user = "@0x0000000000000000000000000000000000000001:ownserver.com"
+    banned_user = "@0x0000000000000000000000000000000000000002:ownserver.com"
+    joined_user = "@0x0000000000000000000000000000000000000003:ownserver.com"
+    for user_id in (left_user, banned_user):
+        store.set_last_seen(network_key, user_id, int(time.time()))
+    mocked_matrix_api.activity_change[joined_user] = 0
+    db_connection = FakeDatabaseConnection(rows=[], stream_position=10)
+
+    # the first sync stores the current position of the delta stream
+    run_user_purger(
+        mocked_matrix_api,
+        store,
+        db_connection=db_connection,
+        member_sync=MEMBER_SYNC_INCREMENTAL,
+    )
+    assert list(store.metadata.values()) == ["10"]
+
+    db_connection.membership_rows = [
+        (11, left_user, "leave"),
+        (12, banned_user, "ban"),
+        (13, joined_user, "join"),
+    ]
+    store.set_last_update(0)
+    run_user_purger(
+        mocked_matrix_api,
+        store,
+        db_connection=db_connection,
+        member_sync=MEMBER_SYNC_INCREMENTAL,
+    )
+
+    delta_params = [
+        params for query, params in db_connection.executed if query == MEMBERSHIP_DELTA_QUERY
+    ]
+    assert [params["stream_id"] for params in delta_params] == [10]
+    user_activity = store.user_activity_info["network_to_users"][network_key]
+    assert set(user_activity.keys()) == {*active_users.keys(), joined_user}
+    assert list(store.metadata.values()) == ["13"]
+
+
+def test_purge_journal_resumes_and_retries(tmp_path):
+    network_key = str(Networks.GOERLI.value)
+    api = GMatrixHttpApiTest("https://ownserver.com")
+    store = SqliteUserActivityStore(str(tmp_path / "user_activity.db"))
+    journal = SqlitePurgeJournal(store.conn)
+    last_seen = int(time.time()) - USER_PURGING_THRESHOLD - 1
+    users = [f"@0x{i:040x}:ownserver.com" for i in range(8)]
+    store.add_network(network_key)
+    store.add_users(network_key, users, last_seen)
+    api.failing_deactivations = {users[0]}
+
+    purge_inactive_users(api, store, {network_key: users[:5]}, journal, concurrency=2)
+    assert journal.count(PurgeJournal.DONE) == 4
+    assert journal.count(PurgeJournal.FAILED) == 1
+
+    # the run is capped, the remaining user stays pending for the next run
+    purge_inactive_users(api, store, {network_key: users[5:]}, journal, max_purges=2)
+    assert journal.count(PurgeJournal.DONE) == 6
+    assert journal.count(PurgeJournal.PENDING) == 1
+
+    # the failed user is only retried after the backoff
+    purge_inactive_users(api, store, {network_key: []}, journal)
+    assert journal.count(PurgeJournal.PENDING) == 0
+    assert store.count_users(network_key) == 1
+    now = int(time.time())
+    assert journal.get_due(network_key, now, 10) == []
+    assert journal.get_due(network_key, now + PURGE_RETRY_BACKOFF, 10) == [users[0]]
+
+
+def test_purge_store_error_propagates(tmp_path):
+    network_key = str(Networks.GOERLI.value)
+    api = GMatrixHttpApiTest("https://ownserver.com")
+    store = SqliteUserActivityStore(str(tmp_path / "user_activity.db"))
+    journal = SqlitePurgeJournal(store.conn)
+    last_seen = int(time.time()) - USER_PURGING_THRESHOLD - 1
+    users = [f"@0x{i:040x}:ownserver.com" for i in range(5)]
+    store.add_network(network_key)
+    store.add_users(network_key, users, last_seen)
+    # the first user is deactivated, but can't be removed from the store
+    remove_user = store.remove_user
+
+    def remove_user_failing_first(network_key, user_id):
+        if user_id == users[0]:
+            raise sqlite3.OperationalError("database is locked")
+        remove_user(network_key, user_id)
+
+    store.remove_user = remove_user_failing_first
+
+    with pytest.raises(sqlite3.OperationalError):
+        purge_inactive_users(api, store, {network_key: users}, journal, concurrency=2)
+
+
+@pytest.mark.parametrize("last_update_in_days", [3])
+@pytest.mark.parametrize("due_users_count, active_users_count", [(5, 10)])
+@pytest.mark.parametrize("activity_changed_count", [2])
+@pytest.mark.parametrize("networks", [[Networks.GOERLI]])
+def test_metrics(mocked_matrix_api, global_user_activity, networks):
+    labels = {"network": str(networks[0].value)}
+    deactivation_labels = {**labels, "result": "done"}
+    deactivations_before = (
+        METRICS_REGISTRY.get_sample_value("purger_deactivations_total", deactivation_labels) or 0
+    )
+
+    run_user_purger(mocked_matrix_api, InMemoryUserActivityStore(global_user_activity))
+
+    get_sample_value = METRICS_REGISTRY.get_sample_value
+    assert get_sample_value("purger_presence_candidates", labels) == 5
+    assert get_sample_value("purger_presence_candidates_remaining", labels) == 0
+    assert get_sample_value("purger_user_activity_store_users", labels) == 12
+    assert (
+        get_sample_value("purger_deactivations_total", deactivation_labels)
+        == deactivations_before + 3
+    )
+
+
+def test_metrics_textfile_written_on_early_exit(tmp_path):
+    credentials_file = tmp_path / "credentials.json"
+    credentials_file.write_text("{}")
+    metrics_textfile = tmp_path / "purger.prom"
+
+    result = CliRunner().invoke(
+        purge,
+        [
+            "https://ownserver.com",
+            "--credentials-file",
+            str(credentials_file),
+            "--metrics-textfile",
+            str(metrics_textfile),
+        ],
+    )
+
+    assert result.exit_code == 1
+    assert "purger_run_success 0.0" in metrics_textfile.read_text()
+
+
+def test_fetch_federation_whitelist_uses_cache(tmp_path, monkeypatch):
+    url = "https://example.com/known_servers.json"
+    whitelist = ["a.example.com", "b.example.com"]
+    requests_headers = []
+
+    def get(url, headers, timeout):
+        requests_headers.append(headers)
+        response = requests.Response()
+        if headers.get("If-None-Match") == "etag":
+            response.status_code = 304
+        else:
+            response.status_code = 200
+            response.headers["ETag"] = "etag"
+            response._content = json.dumps({"all_servers": whitelist}).encode()
+        return response
+
+    monkeypatch.setattr(requests, "get", get)
+    cache = load_whitelist_cache(tmp_path / "cache.json")
+    assert fetch_federation_whitelist(url, cache) == whitelist
+    assert fetch_federation_whitelist(url, cache) == whitelist
+    assert requests_headers == [{}, {"If-None-Match": "etag"}]
+
+    # the last known good whitelist is used if fetching fails
+    def get_failing(url, headers, timeout):
+        raise requests.ConnectionError()
+
+    monkeypatch.setattr(requests, "get", get_failing)
+    assert fetch_federation_whitelist(url, cache) == whitelist
+    assert fetch_federation_whitelist("https://other.example.com", cache) is None
+
+
+def test_restart_outdated_containers(tmp_path):
+    whitelist = ["a.example.com", "b.example.com"]
+    cache = load_whitelist_cache(tmp_path / "cache.json")
+    cache.update(
+        url="https://example.com",
+        whitelist=whitelist,
+        whitelist_hash=whitelist_hash(whitelist),
+    )
+    up_to_date = FakeContainer("1", whitelist, {"restart": "true"})
+    outdated = FakeContainer("2", whitelist[:1], {"restart": "true"})
+    unlabeled = FakeContainer("3", [], {})
+    client = FakeDockerClient([up_to_date, outdated, unlabeled])
+
+    restart_outdated_containers(client, "restart", cache)
+    assert (up_to_date.restarts, outdated.restarts, unlabeled.restarts) == (0, 1, 0)
+
+    # the restarted container is checked once more, the other one isn't read again
+    outdated.whitelist = whitelist
+    restart_outdated_containers(client, "restart", cache)
+    restart_outdated_containers(client, "restart", cache)
+    assert (up_to_date.restarts, outdated.restarts) == (0, 1)
+    assert (up_to_date.execs, outdated.execs) == (1, 2)
+
+
+def test_restart_workers_after_synapse(tmp_path):
+    whitelist = ["a.example.com", "b.example.com"]
+    cache = load_whitelist_cache(tmp_path / "cache.json")
+    cache.update(whitelist=whitelist, whitelist_hash=whitelist_hash(whitelist))
+    restart_log: List[str] = []
+    worker = FakeContainer("worker", whitelist[:1], {"restart": "worker"}, restart_log)
+    synapse = FakeContainer("synapse", whitelist[:1], {"restart": "true"}, restart_log)
+    # docker lists the newest containers first
+    client = FakeDockerClient([worker, synapse])
+
+    # workers aren't restarted before synapse is healthy again
+    synapse.healthy = False
+    restart_outdated_containers(client, "restart", cache, health_timeout=0)
+    assert restart_log == ["synapse"]
+
+    synapse.healthy = True
+    synapse.whitelist = whitelist
+    restart_outdated_containers(client, "restart", cache, health_timeout=0)
+    assert restart_log == ["synapse", "worker"]
+
+    # on the next whitelist change both are restarted in the same run
+    cache.update(whitelist=whitelist[1:], whitelist_hash=whitelist_hash(whitelist[1:]))
+    restart_log.clear()
+    restart_outdated_containers(client, "restart", cache, health_timeout=0)
+    assert restart_log == ["synapse", "worker"]
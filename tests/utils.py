@@ -1,7 +1,10 @@
+import hashlib
+import json
 import string
 import time
 from random import choice, randint
-from typing import Dict
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Set, Tuple
 
 from matrix_client.errors import MatrixRequestError
 
@@ -15,11 +18,16 @@ class GMatrixHttpApiTest(GMatrixHttpApi):
         self.server_name = server_name
         self.user_presence = user_presence
         self.activity_change = activity_change
+        self.member_events: List[Dict] = []
+        self.room_ids: Dict[str, str] = {}
+        self.failing_deactivations: Set[str] = set()
 
     def get_room_id(self, room_alias) -> str:
-        letters = string.ascii_lowercase
-        random_room_id = "".join(choice(letters) for i in range(10))
-        return f"!{random_room_id}:{self.server_name}"
+        if room_alias not in self.room_ids:
+            letters = string.ascii_lowercase
+            random_room_id = "".join(choice(letters) for i in range(10))
+            self.room_ids[room_alias] = f"!{random_room_id}:{self.server_name}"
+        return self.room_ids[room_alias]
 
     def get_presence(self, user_id):
         if user_id in self.activity_change:
@@ -32,13 +40,117 @@ class GMatrixHttpApiTest(GMatrixHttpApi):
     def get_joined_members(self, room_id):
         return self.user_presence
 
-    # this is a hack because _send is only called upon fetching room members via admin api
     def _send(
-        self, method, path, content=None, query_params=None, headers=None, api_path="",
+        self,
+        method,
+        path,
+        content=None,
+        query_params=None,
+        headers=None,
+        api_path="",
     ):
+        if path.endswith("/messages"):
+            # only membership events are requested, all of them fit into one page
+            if query_params.get("dir") == "f" and query_params["from"] != "end":
+                return {"start": query_params["from"], "end": "end", "chunk": self.member_events}
+            return {"start": "end", "chunk": []}
+        deactivated_user_id = path[len("/deactivate/") :]
+        if path.startswith("/deactivate/") and deactivated_user_id in self.failing_deactivations:
+            raise MatrixRequestError(code=500, content="deactivation failed")
+        # fetching room members or deactivating users via admin api
         return {"members": []}
 
 
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def execute(self, query, params=None):
+        self.connection.executed.append((query, params))
+        if "MAX(stream_id)" in query:
+            self.result = [(self.connection.stream_position,)]
+        elif "current_state_delta_stream" in query:
+            self.result = self.connection.membership_rows
+        else:
+            self.result = self.connection.rows
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        return self.result
+
+
+class FakeDatabaseConnection:
+    """Stands in for a psycopg2 connection returning fixed query results"""
+
+    def __init__(
+        self,
+        rows: List[Tuple[str, Optional[int], str]],
+        membership_rows: List[Tuple[int, str, str]] = None,
+        stream_position: int = 0,
+    ):
+        self.rows = rows
+        self.membership_rows = membership_rows or []
+        self.stream_position = stream_position
+        self.executed: List[Tuple[str, Optional[Dict]]] = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakeContainer:
+    def __init__(
+        self,
+        container_id: str,
+        whitelist: List[str],
+        labels: Dict[str, str],
+        restart_log: Optional[List[str]] = None,
+    ):
+        self.id = container_id
+        self.name = f"container_{container_id}"
+        self.whitelist = whitelist
+        self.restarts = 0
+        self.execs = 0
+        self.healthy = True
+        self.restart_log = restart_log if restart_log is not None else []
+        self.attrs = {
+            "State": {"Status": "running", "StartedAt": "0", "Health": {"Status": "healthy"}},
+            "Config": {"Labels": labels},
+        }
+
+    def exec_run(self, cmd):
+        # returns the whitelist hash written by the synapse entrypoint
+        self.execs += 1
+        output = hashlib.sha256(json.dumps(self.whitelist).encode()).hexdigest()
+        return SimpleNamespace(exit_code=0, output=output.encode())
+
+    def restart(self, timeout):
+        self.restarts += 1
+        self.restart_log.append(self.id)
+        self.attrs["State"]["StartedAt"] = str(self.restarts)
+        self.attrs["State"]["Health"]["Status"] = "starting"
+
+    def reload(self):
+        if self.healthy:
+            self.attrs["State"]["Health"]["Status"] = "healthy"
+
+
+class FakeDockerClient:
+    def __init__(self, containers: List[FakeContainer]):
+        self.containers = SimpleNamespace(list=lambda: containers)
+
+
 def create_user_activity_dict(size: int, lower_bound: int, upper_bound: int) -> Dict[str, int]:
     """
 